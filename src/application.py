@@ -1,22 +1,34 @@
 import os
 
+# Settings are read by resources as they are imported, so .env is loaded first
+from dotenv import load_dotenv, find_dotenv
+load_dotenv(find_dotenv())
+
 from flask import Flask
 from flask_restful import Api
 from resources.snodas.SNODAS import SNODAS
 from resources.obs.Obs import Obs
+from resources.obs.Obs_Aggregate import Obs_Aggregate
 from resources.obs.Obs_Database import Obs_Database
 from resources.snodas.SNODAS_Database import SNODAS_Database
-
-from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv())
+from resources.snodas.SNODAS_Compare import SNODAS_Compare
+from common.formats import compress_response
 
 application = Flask(__name__)
 application.config['RESTFUL_JSON'] = {'indent': 4}
+application.after_request(compress_response)
 
 api = Api(application)
 
 obs_db = Obs_Database()
 api.add_resource(Obs, '/obs', resource_class_args = [obs_db])
+api.add_resource(Obs_Aggregate, '/obs/aggregate', resource_class_args = [obs_db])
+
+# SNODAS ingest downloads and stores years of grids, so it only runs if enabled
+if os.getenv('SNODAS_ENABLED'):
+    snodas_db = SNODAS_Database()
+    api.add_resource(SNODAS, '/snodas', resource_class_args = [snodas_db])
+    api.add_resource(SNODAS_Compare, '/compare', resource_class_args = [obs_db, snodas_db])
 
 if __name__ == '__main__':
     application.debug = False
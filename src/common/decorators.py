@@ -1,4 +1,5 @@
 from functools import wraps
+from collections import OrderedDict
 import threading
 import time
 
@@ -44,50 +45,156 @@ def locked(func):
         return res
     return wrapper
 
-def cache(ttl=60, max_size=128):
-
-    hash_separator = object()
-    cache = {}
-    queue = []
-
-    def insert(key, val):
-        # Make sure cache does not exceed max_size
-        while len(cache) >= max_size or len(queue) >= max_size:
-            remove()
-        cache[key] = (time.time(), val)
-        queue.append(key)
-
-    def update(key, val):
-        # Move key to end of queue and update value
-        if key in queue:
-            index = queue.index(key)
-            del queue[index]
-        queue.append(key)
-        cache[key] = (time.time(), val)
-
-    def remove():
-        # Remove oldest key from cache
-        key = queue[0]
-        del queue[0]
-        del cache[key]
+def retry(tries=5, delay=1, backoff=2, exceptions=(Exception,)):
+    """Retry function on failure, waiting longer after each attempt.
 
+    Keyword arguments:
+    tries -- Maximum number of attempts
+    delay -- Seconds to wait after first failure
+    backoff -- Factor wait grows by after each failure
+    exceptions -- Exception types that are retried
+    """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Get unique key based on arguments passed to function
-            key = hash(args + (hash_separator,) + tuple(sorted(kwargs.items())))
-            if key in cache:
-                cached_at, val = cache.get(key)
-                if time.time() - cached_at > ttl:
-                    new_val = func(*args, **kwargs)
-                    update(key, new_val)
-                    return new_val
-                else:
+            wait = delay
+            for attempt in range(tries - 1):
+                try:
+                    return func(*args, **kwargs)
+                except exceptions:
+                    time.sleep(wait)
+                    wait *= backoff
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def rate_limited(per_second):
+    """Space calls to function so at most per_second start each second,
+    across all threads.
+
+    Keyword arguments:
+    per_second -- Maximum calls per second
+    """
+    interval = 1.0 / per_second
+    lock = threading.Lock()
+    next_call = 0.0
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            nonlocal next_call
+            # Reserve a slot, then wait for it without holding lock
+            with lock:
+                now = time.monotonic()
+                start = max(now, next_call)
+                next_call = start + interval
+            time.sleep(start - now)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class LRUCache():
+    """Thread-safe LRU cache with per-entry expiry.
+
+    Concurrent misses on the same key are coalesced so that only one caller
+    computes the value while the others wait for it.
+    """
+
+    def __init__(self, ttl=60, max_size=128):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stats = { 'hits' : 0, 'misses' : 0, 'evictions' : 0, 'expirations' : 0, 'waits' : 0 }
+
+    def __lookup(self, key):
+        # Must be called with lock held
+        if key in self.entries:
+            expires_at, val = self.entries[key]
+            if time.time() < expires_at:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return True, val
+            del self.entries[key]
+            self.stats['expirations'] += 1
+        return False, None
+
+    def get(self, key):
+        """Get (found, value) for key, counting a miss if not found."""
+        with self.lock:
+            found, val = self.__lookup(key)
+            if not found:
+                self.stats['misses'] += 1
+            return found, val
+
+    def put(self, key, val):
+        """Insert value, evicting least recently used entries if full."""
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, val)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get_or_compute(self, key, func):
+        """Get value for key, calling func once across threads on a miss."""
+        while True:
+            with self.lock:
+                found, val = self.__lookup(key)
+                if found:
                     return val
-            else:
-                val = func(*args, **kwargs)
-                insert(key, val)
-                return val
+                event = self.in_flight.get(key)
+                if event is None:
+                    event = self.in_flight[key] = threading.Event()
+                    self.stats['misses'] += 1
+                    break
+                self.stats['waits'] += 1
+            # Another thread is computing value, retry once it is done
+            event.wait()
+
+        try:
+            val = func()
+            self.put(key, val)
+            return val
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        """Get hit/miss/eviction counters and current size."""
+        with self.lock:
+            return { **self.stats, 'size' : len(self.entries), 'max_size' : self.max_size }
+
+def cache(ttl=60, max_size=128, normalize=None):
+    """Cache results of function by its arguments.
+
+    Keyword arguments:
+    ttl -- Seconds entries stay valid
+    max_size -- Maximum number of entries kept
+    normalize -- Function taking the same arguments as the cached function and
+                 returning equivalent canonical (args, kwargs), used both as key
+                 and to call the function
+    """
+
+    kwargs_separator = object()
+    lru = LRUCache(ttl=ttl, max_size=max_size)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if normalize is not None:
+                args, kwargs = normalize(*args, **kwargs)
+            # Get unique key based on arguments passed to function
+            key = args + (kwargs_separator,) + tuple(sorted(kwargs.items()))
+            return lru.get_or_compute(key, lambda: func(*args, **kwargs))
 
+        wrapper.cache = lru
+        wrapper.cache_info = lru.info
+        wrapper.cache_clear = lru.clear
         return wrapper
     return decorator
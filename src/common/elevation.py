@@ -1,21 +1,178 @@
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 import os
+import sqlite3
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from osgeo import gdal
 
-from common.decorators import batch
+from common.decorators import retry, rate_limited
 
 BASE_ELEVATION_URL = 'https://maps.googleapis.com/maps/api/elevation/json'
+# Points per request to elevation API
+BATCH_SIZE = 128
+# Requests to elevation API in flight at once
+WORKERS = int(os.getenv('ELEVATION_WORKERS', 4))
+# Maximum requests per second to elevation API
+RATE_LIMIT = float(os.getenv('ELEVATION_RATE_LIMIT', 10))
+# Decimal places coordinates are rounded to before lookup (about 1 m)
+PRECISION = 5
+# API statuses that succeed if retried later
+TRANSIENT_STATUSES = ['OVER_QUERY_LIMIT', 'UNKNOWN_ERROR']
 
-@batch(size=128)
-def with_elevation(data: List[Dict]) -> List[Dict]:
+class TransientError(Exception):
+    """Elevation API failure that is worth retrying."""
+
+class DEM():
+    """Digital elevation model read from a north-up GeoTIFF in lat/long,
+    memory-mapped when GDAL supports it for the file."""
+
+    def __init__(self, path):
+        self.ds = gdal.Open(path)
+        if self.ds is None:
+            raise ValueError('Cannot open DEM %s' % path)
+        band = self.ds.GetRasterBand(1)
+        self.transform = self.ds.GetGeoTransform()
+        if self.transform[2] != 0 or self.transform[4] != 0:
+            raise ValueError('DEM %s must be north-up' % path)
+        self.ndv = band.GetNoDataValue()
+        try:
+            self.values = band.GetVirtualMemAutoArray(gdal.GF_Read)
+        except (RuntimeError, AttributeError):
+            # Compressed or tiled files cannot be mapped, read them once instead
+            self.values = band.ReadAsArray()
+
+    def sample(self, lat, long):
+        """Get elevations at points by bilinear interpolation between cell
+        centers, NaN for points outside DEM or next to missing cells.
+
+        Keyword arguments:
+        lat -- Array of latitudes
+        long -- Array of longitudes
+        """
+        height, width = self.values.shape
+        # Fractional row and column, with cell centers at whole numbers
+        rows = (np.asarray(lat, dtype='float64') - self.transform[3]) / self.transform[5] - 0.5
+        cols = (np.asarray(long, dtype='float64') - self.transform[0]) / self.transform[1] - 0.5
+        inside = (rows >= -0.5) & (rows <= height - 0.5) & (cols >= -0.5) & (cols <= width - 0.5)
+        # Points within half a cell of the edge use the edge cells
+        row_0 = np.clip(np.floor(rows), 0, max(height - 2, 0)).astype('int64')
+        col_0 = np.clip(np.floor(cols), 0, max(width - 2, 0)).astype('int64')
+        row_1 = np.minimum(row_0 + 1, height - 1)
+        col_1 = np.minimum(col_0 + 1, width - 1)
+        row_f = np.clip(rows - row_0, 0, 1)
+        col_f = np.clip(cols - col_0, 0, 1)
+
+        corners = [self.values[r, c].astype('float64') for r, c in [(row_0, col_0), (row_0, col_1), (row_1, col_0), (row_1, col_1)]]
+        if self.ndv is not None:
+            for corner in corners:
+                corner[corner == self.ndv] = np.nan
+        top = corners[0] * (1 - col_f) + corners[1] * col_f
+        bottom = corners[2] * (1 - col_f) + corners[3] * col_f
+        elevations = top * (1 - row_f) + bottom * row_f
+        elevations[~inside] = np.nan
+        return elevations
+
+class ElevationCache():
+    """Elevations of looked up coordinates, persisted in SQLite and held in
+    memory once loaded."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.db = None
+        self.elevations = {}
+
+    @staticmethod
+    def key(lat, long):
+        return round(float(lat), PRECISION), round(float(long), PRECISION)
+
+    def open(self):
+        # Must be called with lock held
+        if self.db is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS elevations (lat REAL, long REAL, elevation REAL, PRIMARY KEY (lat, long))')
+        for lat, long, elevation in self.db.execute('SELECT lat, long, elevation FROM elevations'):
+            self.elevations[(lat, long)] = elevation
+
+    def get_many(self, keys: List[Tuple]) -> Dict[Tuple, float]:
+        with self.lock:
+            self.open()
+            return { key : self.elevations[key] for key in keys if key in self.elevations }
+
+    def put_many(self, elevations: Dict[Tuple, float]):
+        with self.lock:
+            self.open()
+            self.db.executemany('INSERT OR REPLACE INTO elevations VALUES (?, ?, ?)', [(lat, long, elevation) for (lat, long), elevation in elevations.items()])
+            self.db.commit()
+            self.elevations.update(elevations)
+
+# Local elevation model sampled before falling back to elevation API, opened by local_dem
+dem = None
+dem_opened = False
+dem_lock = Lock()
+
+def local_dem() -> Optional[DEM]:
+    """Get DEM at ELEVATION_DEM_PATH, opened on first use, or None if it is not set."""
+    global dem, dem_opened
+    with dem_lock:
+        if not dem_opened:
+            path = os.getenv('ELEVATION_DEM_PATH')
+            dem = DEM(path) if path else None
+            dem_opened = True
+        return dem
+
+cache = ElevationCache(os.getenv('ELEVATION_CACHE_PATH', '.store/elevation.sqlite'))
+
+# Connections are kept alive and shared by concurrent requests
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=WORKERS))
+
+# Other errors, like a missing or rejected API key, fail without retrying
+@retry(tries=5, delay=1, backoff=2, exceptions=(requests.ConnectionError, requests.Timeout, TransientError))
+@rate_limited(RATE_LIMIT)
+def fetch_elevations(keys: List[Tuple]) -> List[float]:
     params = {
-        'locations': "|".join([",".join([str(x['lat']), str(x['long'])]) for x in data]),
+        'locations': "|".join(["%s,%s" % key for key in keys]),
         'key': os.getenv('GOOGLE_API_KEY')
     }
-    res = requests.get(BASE_ELEVATION_URL, params=params).json()
+    res = session.get(BASE_ELEVATION_URL, params=params, timeout=30)
+    if res.status_code >= 500:
+        raise TransientError('Elevation API returned %d' % res.status_code)
+    res.raise_for_status()
+    res = res.json()
+    if res.get('status') in TRANSIENT_STATUSES:
+        raise TransientError(res)
     if 'results' not in res:
         raise ValueError(res)
+    return [result['elevation'] for result in res['results']]
+
+def with_elevation(data: List[Dict]) -> List[Dict]:
+    keys = [ElevationCache.key(x['lat'], x['long']) for x in data]
+    elevations = {}
+    dem = local_dem()
+    if dem is not None:
+        sampled = dem.sample([lat for lat, long in keys], [long for lat, long in keys])
+        elevations = { key : elevation for key, elevation in zip(keys, sampled.tolist()) if not np.isnan(elevation) }
+    missing = [key for key in keys if key not in elevations]
+    elevations.update(cache.get_many(missing))
+    # Only coordinates never looked up before are requested, each once
+    unseen = list(OrderedDict.fromkeys(key for key in keys if key not in elevations))
+    batches = [unseen[i:i + BATCH_SIZE] for i in range(0, len(unseen), BATCH_SIZE)]
+    if len(batches) > 0:
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            for batch_keys, batch_elevations in zip(batches, pool.map(fetch_elevations, batches)):
+                found = dict(zip(batch_keys, batch_elevations))
+                cache.put_many(found)
+                elevations.update(found)
 
-    results = [{ **data, 'elevation': res['elevation'] } for data, res in zip(data, res['results'])]
+    results = [{ **x, 'elevation': elevations[key] } for x, key in zip(data, keys)]
     return results
@@ -0,0 +1,90 @@
+import gzip
+from io import BytesIO
+
+from flask import Response, request
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Formats records can be returned in besides JSON, with their media types
+FORMATS = {
+    'csv' : 'text/csv',
+    'arrow' : 'application/vnd.apache.arrow.stream',
+    'parquet' : 'application/vnd.apache.parquet'
+}
+# Formats encoded with pyarrow
+ARROW_FORMATS = ['arrow', 'parquet']
+# Smallest response worth compressing
+MIN_COMPRESS_BYTES = 1024
+
+def negotiate(format=None):
+    """Get name of format to return records in, from format parameter or
+    else Accept header of request. Returns None for JSON.
+
+    Keyword arguments:
+    format -- Value of format parameter, if any
+    """
+    if format:
+        return None if format == 'json' else format
+    for media_type in request.accept_mimetypes.values():
+        if media_type == 'application/json' or media_type == '*/*':
+            return None
+        for name, format_type in FORMATS.items():
+            if media_type == format_type:
+                return name
+    return None
+
+def available(format):
+    """Whether format can be encoded with installed packages."""
+    return format in FORMATS and (pa is not None or format not in ARROW_FORMATS)
+
+def encode(df, format):
+    """Encode dataframe in format.
+
+    Keyword arguments:
+    df -- Dataframe to encode
+    format -- Name of format, one of FORMATS
+    """
+    if format == 'csv':
+        return df.to_csv(index=False).encode('utf-8')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    buffer = BytesIO()
+    if format == 'arrow':
+        with pa.RecordBatchStreamWriter(buffer, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, buffer)
+    return buffer.getvalue()
+
+def frame_response(df, format):
+    """Get response of dataframe encoded in format."""
+    return Response(encode(df, format), mimetype=FORMATS[format])
+
+def compress_response(response):
+    """Compress response with brotli or gzip if client accepts it. Streamed
+    and small responses are passed through."""
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers \
+            or response.status_code != 200:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_BYTES:
+        return response
+    encodings = request.accept_encodings
+    if brotli is not None and 'br' in encodings:
+        response.set_data(brotli.compress(data))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in encodings:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    response.headers.add('Vary', 'Accept-Encoding')
+    return response
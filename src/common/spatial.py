@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+
+class GridIndex():
+    """Bucket index mapping fixed-degree grid cells to row positions."""
+
+    def __init__(self, cell_size=0.5):
+        self.cell_size = cell_size
+        self.buckets = {}
+
+    def __len__(self):
+        return sum(len(positions) for positions in self.buckets.values())
+
+    def cells(self, lat, long):
+        """Get grid cell coordinates for arrays of points.
+
+        Keyword arguments:
+        lat -- Array of latitudes
+        long -- Array of longitudes
+        """
+        rows = np.floor(np.asarray(lat, dtype='float64') / self.cell_size).astype('int64')
+        cols = np.floor(np.asarray(long, dtype='float64') / self.cell_size).astype('int64')
+        return rows, cols
+
+    def insert(self, lat, long, positions):
+        """Add points to index.
+
+        Keyword arguments:
+        lat -- Array of latitudes
+        long -- Array of longitudes
+        positions -- Row positions of points
+        """
+        positions = np.asarray(positions, dtype='int64')
+        if len(positions) == 0:
+            return
+        rows, cols = self.cells(lat, long)
+        keys = np.stack([rows, cols], axis=1)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for i, (row, col) in enumerate(unique):
+            key = (int(row), int(col))
+            added = positions[inverse == i]
+            if key in self.buckets:
+                self.buckets[key] = np.sort(np.concatenate([self.buckets[key], added]))
+            else:
+                self.buckets[key] = np.sort(added)
+
+    def shift(self, inserts):
+        """Renumber positions after rows are inserted.
+
+        Keyword arguments:
+        inserts -- Sorted positions (in current numbering) before which rows are inserted
+        """
+        inserts = np.asarray(inserts, dtype='int64')
+        for key, positions in self.buckets.items():
+            self.buckets[key] = positions + np.searchsorted(inserts, positions, side='right')
+
+    def candidates(self, bounds):
+        """Get sorted positions of points in cells overlapping bounding box.
+
+        Keyword arguments:
+        bounds -- Tuple of (min_long, min_lat, max_long, max_lat)
+        """
+        min_long, min_lat, max_long, max_lat = bounds
+        min_row, max_row = math.floor(min_lat / self.cell_size), math.floor(max_lat / self.cell_size)
+        min_col, max_col = math.floor(min_long / self.cell_size), math.floor(max_long / self.cell_size)
+
+        # Scan whichever is smaller, cells in box or occupied cells
+        if (max_row - min_row + 1) * (max_col - min_col + 1) <= len(self.buckets):
+            keys = ((row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1))
+            found = [self.buckets[key] for key in keys if key in self.buckets]
+        else:
+            found = [positions for (row, col), positions in self.buckets.items()
+                     if min_row <= row <= max_row and min_col <= col <= max_col]
+
+        if len(found) == 0:
+            return np.empty(0, dtype='int64')
+        return np.sort(np.concatenate(found))
+
+def points_in_polygon(x, y, polygon):
+    """Vectorized even-odd test of points against a shapely polygon.
+
+    Keyword arguments:
+    x -- Array of x coordinates (longitude)
+    y -- Array of y coordinates (latitude)
+    polygon -- Shapely polygon
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    inside = np.zeros(len(x), dtype=bool)
+    rings = [polygon.exterior] + list(polygon.interiors)
+    for ring in rings:
+        coords = np.asarray(ring.coords, dtype='float64')
+        x1, y1 = coords[:-1, 0], coords[:-1, 1]
+        x2, y2 = coords[1:, 0], coords[1:, 1]
+        for ax, ay, bx, by in zip(x1, y1, x2, y2):
+            if ay == by:
+                continue
+            crosses = (ay > y) != (by > y)
+            intersect_x = (bx - ax) * (y - ay) / (by - ay) + ax
+            inside ^= crosses & (x < intersect_x)
+    return inside
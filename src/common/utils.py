@@ -1,16 +1,17 @@
 from functools import wraps
 import time
-from io import BytesIO
 import threading
 import pandas as pd
 import urllib.request
 import geopandas as gpd
 from datetime import datetime
-import tarfile
 import polyline
 from shapely.geometry import Point, Polygon, shape
+from shapely.geometry.polygon import orient
 from osgeo import gdal, gdal_array, osr
 import re
+import os
+import json
 import numpy as np
 
 def empty_cso_dataframe():
@@ -63,6 +64,22 @@ def decoded_polygon(str):
         except:
             return None
 
+def canonical_region(str):
+    """Get canonical encoded polyline for region, so that equal polygons
+    given in different formats, orientations or starting vertices compare
+    equal. Returns region unchanged if it cannot be decoded.
+
+    Keyword arguments:
+    str -- Region in any format accepted by decoded_polygon
+    """
+    polygon = decoded_polygon(str)
+    if polygon is None:
+        return str
+    coords = list(orient(polygon).exterior.coords)[:-1]
+    start = coords.index(min(coords))
+    coords = coords[start:] + coords[:start]
+    return polyline.encode([x[::-1] for x in coords])
+
 def most_recent_hour():
     now = time.time() * 1000
     dt = timestamp_to_date(now).replace(minute=0, second=0)
@@ -84,34 +101,13 @@ def gdal_metadata(source):
 
     return ndv, width, height, transform, projection, dtype
 
-def url_to_io(url):
-    """Get raw bytes from url.
+def url_to_stream(url):
+    """Get file object reading from url as data arrives, without buffering it.
 
     Keyword arguments:
     url -- URL to fetch data from
     """
-    stream = urllib.request.urlopen(url)
-    bytes = BytesIO()
-    while True:
-        next = stream.read(16384)
-        if not next:
-            break
-
-        bytes.write(next)
-
-    stream.close()
-    bytes.seek(0)
-    return bytes
-
-def url_to_tar(url):
-    """Get tar object from url.
-
-    Keyword arguments:
-    url -- URL of SNODAS data for specific date
-    """
-    io = url_to_io(url)
-    tar = tarfile.open(fileobj = io, mode = 'r')
-    return tar
+    return urllib.request.urlopen(url)
 
 def save_ds(ds, path, driver):
     """Save GDAL dataset using arbitrary driver.
@@ -143,14 +139,89 @@ def save_tiff(ds, path):
     """
     save_ds(ds, path, 'GTiff')
 
-def save_netcdf(ds, path):
-    """Save GDAL dataset as NetCDF file.
+def write_atomic(path, data):
+    """Write bytes to file so readers see either old or new contents.
 
     Keyword arguments:
-    ds -- GDAl dataset
     path -- Location where file will be saved
+    data -- Bytes to write
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+def save_json(obj, path):
+    """Atomically save object as JSON file.
+
+    Keyword arguments:
+    obj -- JSON serializable object
+    path -- Location where file will be saved
+    """
+    write_atomic(path, json.dumps(obj).encode('utf-8'))
+
+def load_json(path, default=None):
+    """Load JSON file, returning default if it does not exist.
+
+    Keyword arguments:
+    path -- Location of file
+    default -- Value returned if file does not exist
+    """
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as file:
+        return json.load(file)
+
+def save_columns(df, path, dtypes):
+    """Save DataFrame as directory of .npy files, one per column.
+
+    Columns not in dtypes are saved as fixed width strings, with a mask of
+    null values if there are any. The directory is renamed into place once
+    all columns are written.
+
+    Keyword arguments:
+    df -- DataFrame to save
+    path -- Directory where columns will be saved
+    dtypes -- Dictionary of column name to numpy dtype for non-string columns
+    """
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    for column in df.columns:
+        values = df[column]
+        if column in dtypes:
+            arrays = { column : values.values.astype(dtypes[column]) }
+        else:
+            nulls = values.isnull().values
+            arrays = { column : np.asarray(values.where(~nulls, '').astype(str).values, dtype=str) }
+            if nulls.any():
+                arrays[column + '.null'] = nulls
+        for name, array in arrays.items():
+            with open(os.path.join(tmp_path, name + '.npy'), 'wb') as file:
+                np.save(file, array)
+                file.flush()
+                os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+def load_columns(path, columns):
+    """Load DataFrame from directory of .npy files saved by save_columns.
+    String columns are loaded as objects, like frames built from records.
+
+    Keyword arguments:
+    path -- Directory columns were saved to
+    columns -- Names of columns to load
     """
-    save_ds(ds, path, 'netCDF')
+    data = {}
+    for column in columns:
+        values = np.load(os.path.join(path, column + '.npy'))
+        if values.dtype.kind == 'U':
+            values = values.astype(object)
+        null_path = os.path.join(path, column + '.null.npy')
+        if os.path.exists(null_path):
+            values[np.load(null_path)] = None
+        data[column] = values
+    return pd.DataFrame(data, columns=columns)
 
 def error_message(str):
     return { 'message' : str }
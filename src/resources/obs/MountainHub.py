@@ -6,39 +6,29 @@ import geopandas as gpd
 import requests
 
 from flask_restful import fields, marshal, reqparse, Resource, inputs
-from common.utils import empty_cso_dataframe
-from common.elevation import with_elevation
 from common.decorators import unsafe, cache
+from resources.obs.Obs_Source import Obs_Source
 
 BASE_URL = 'https://api.mountainhub.com/timeline'
 HEADER = { 'Accept-version': '1' }
-ONE_MONTH = 2592000000
+# Windows fetched from MountainHub at once
+MAX_WORKERS = 4
+# Most results returned for one request
+PAGE_LIMIT = 10000
+# Shortest window full pages are split into, in milliseconds (one minute)
+MIN_WINDOW = 60000
 
-class MountainHub():
+class MountainHub(Obs_Source):
+
+    max_workers = MAX_WORKERS
+    page_limit = PAGE_LIMIT
+    min_window = MIN_WINDOW
 
     def __init__(self):
+        super().__init__()
         self.key = "MountainHub"
         self.state = { 'min_timestamp': 1476705600000, 'max_timestamp': 1476705600000 }
 
-    def get_new_data(self):
-        if ('max_timestamp' in self.state):
-            ts = self.state['max_timestamp']
-            for block in self.__get_data(ts):
-                yield block
-            self.state['max_timestamp'] = int(time.time() * 1000)
-
-    def get_all_data(self):
-        if ('min_timestamp' in self.state):
-            ts = self.state['min_timestamp']
-            for block in self.__get_data(ts):
-                yield block
-
-    def __get_data(self, timestamp):
-        while timestamp < int(time.time() * 1000):
-            block = self.__fetch_raw_data(timestamp, min(timestamp + ONE_MONTH, int(time.time() * 1000)))
-            yield block
-            timestamp += ONE_MONTH
-
     @unsafe
     def __parse_data(self, record):
 
@@ -54,12 +44,12 @@ class MountainHub():
 
         return marshal(record, cso_format)
 
-    def __fetch_raw_data(self, min_timestamp, max_timestamp):
+    def fetch_records(self, min_timestamp, max_timestamp):
 
         args = {
             'publisher' : 'all',
             'obs_type' : 'snow_conditions',
-            'limit' : 10000,
+            'limit' : PAGE_LIMIT,
             'since' : min_timestamp,
             'before' : max_timestamp,
         }
@@ -68,14 +58,9 @@ class MountainHub():
         data = response.json()
 
         if 'results' not in data or len(data['results']) == 0:
-            return empty_cso_dataframe()
+            return [], 0
         else:
             results = data['results']
             all_results = [ self.__parse_data(result) for result in results ]
             valid_results = [result for result in all_results if result is not None]
-            valid_results = with_elevation(valid_results)
-            if len(valid_results) == 0:
-                return empty_cso_dataframe()
-
-            df = pd.DataFrame.from_records(valid_results)
-            return df
+            return valid_results, len(results)
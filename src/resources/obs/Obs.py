@@ -2,18 +2,23 @@ import json
 import time
 import math
 
+from flask import Response
 from flask_restful import fields, marshal, reqparse, Resource, inputs
 from datetime import datetime
-from common.utils import most_recent_hour
+from common.utils import most_recent_hour, error_message
+from common.formats import FORMATS, negotiate, available, frame_response
 from common.elevation import with_elevation
 
 parser = reqparse.RequestParser(bundle_errors=True)
-parser.add_argument('limit', type=int, default=100)
-parser.add_argument('start', type=int, default=1457458000000)
-parser.add_argument('end', type=int, default = 0)
-parser.add_argument('page', type=int, default=1)
-parser.add_argument('region', type=str, default = '')
-parser.add_argument('source', type=str, default = '')
+parser.add_argument('limit', type=int, default=100, location='args')
+parser.add_argument('start', type=int, default=1457458000000, location='args')
+parser.add_argument('end', type=int, default = 0, location='args')
+parser.add_argument('page', type=int, default=1, location='args')
+parser.add_argument('region', type=str, default = '', location='args')
+parser.add_argument('source', type=str, default = '', location='args')
+parser.add_argument('cursor', type=str, default = '', location='args')
+parser.add_argument('stream', type=str, default = '', choices=['', 'json', 'ndjson'], location='args')
+parser.add_argument('format', type=str, default = '', choices=['', 'json'] + list(FORMATS), location='args')
 
 args_format = {
     'limit' : fields.Integer,
@@ -21,7 +26,8 @@ args_format = {
     'end' : fields.Integer(default=int(time.time() * 1000)),
     'page' : fields.Integer,
     'region' : fields.String,
-    'source' : fields.String
+    'source' : fields.String,
+    'cursor' : fields.String
 }
 
 class Obs(Resource):
@@ -30,6 +36,35 @@ class Obs(Resource):
         self.db = db
 
     def get(self):
-        args = marshal(parser.parse_args(), args_format)
+        parsed = parser.parse_args()
+        args = marshal(parsed, args_format)
         args['end'] = args['end'] or most_recent_hour()
+        if parsed['stream']:
+            return self.stream(args, parsed['stream'])
+        format = negotiate(parsed['format'])
+        if format:
+            return self.frame(args, format)
         return self.db.query(**dict(args))
+
+    def frame(self, args, format):
+        if not available(format):
+            return error_message('Format %s is not supported by this server' % format), 406
+        selection = self.db.query_frame(**dict(args))
+        if selection is None:
+            return self.db.invalid(args['region'], args['cursor'])
+        df, next = selection
+        response = frame_response(df, format)
+        if next is not None:
+            response.headers['X-Next-Cursor'] = next
+        return response
+
+    def stream(self, args, stream):
+        lines = stream == 'ndjson'
+        selection = self.db.query_stream(**dict(args), lines=lines)
+        if selection is None:
+            return self.db.invalid(args['region'], args['cursor'])
+        chunks, next = selection
+        response = Response(chunks, mimetype='application/x-ndjson' if lines else 'application/json')
+        if next is not None:
+            response.headers['X-Next-Cursor'] = next
+        return response
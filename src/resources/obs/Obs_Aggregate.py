@@ -0,0 +1,65 @@
+from flask_restful import fields, marshal, reqparse, Resource, inputs
+from common.utils import most_recent_hour, error_message
+from common.formats import FORMATS, negotiate, available, frame_response
+from resources.obs.Obs import args_format as obs_args_format
+from resources.obs.Obs_Database import INTERVALS
+from resources.snodas.SNODAS_Grid import SNODAS_Grid
+
+# Bins observations can be grouped into spatially
+BINS = ['', 'degree', 'snodas']
+# Numeric fields statistics can be computed of
+FIELDS = ['snow_depth', 'elevation']
+
+parser = reqparse.RequestParser(bundle_errors=True)
+parser.add_argument('start', type=int, default=1457458000000, location='args')
+parser.add_argument('end', type=int, default = 0, location='args')
+parser.add_argument('region', type=str, default = '', location='args')
+parser.add_argument('source', type=str, default = '', location='args')
+parser.add_argument('interval', type=str, default = '', choices=[''] + list(INTERVALS), location='args')
+parser.add_argument('bin', type=str, default = '', choices=BINS, location='args')
+parser.add_argument('cell_size', type=float, default = 1.0, location='args')
+parser.add_argument('by_source', type=inputs.boolean, default = False, location='args')
+parser.add_argument('percentiles', type=str, default = '', location='args')
+parser.add_argument('field', type=str, default = 'snow_depth', choices=FIELDS, location='args')
+parser.add_argument('format', type=str, default = '', choices=['', 'json'] + list(FORMATS), location='args')
+
+args_format = { name : obs_args_format[name] for name in ['start', 'end', 'region', 'source'] }
+
+# Shared so aggregations by SNODAS cell share cache entries
+snodas_grid = SNODAS_Grid.unmasked()
+
+class Obs_Aggregate(Resource):
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self):
+        parsed = parser.parse_args()
+        args = marshal(parsed, args_format)
+        args['end'] = args['end'] or most_recent_hour()
+        try:
+            percentiles = tuple(float(p) for p in parsed['percentiles'].split(',') if p.strip())
+        except ValueError:
+            return error_message('Percentiles must be comma separated numbers'), 400
+        if any(p < 0 or p > 100 for p in percentiles):
+            return error_message('Percentiles must be between 0 and 100'), 400
+        if parsed['bin'] == 'degree' and parsed['cell_size'] <= 0:
+            return error_message('Cell size must be positive'), 400
+
+        options = {
+            'interval' : parsed['interval'],
+            'cell_size' : parsed['cell_size'] if parsed['bin'] == 'degree' else 0,
+            'grid' : snodas_grid if parsed['bin'] == 'snodas' else None,
+            'by_source' : parsed['by_source'],
+            'percentiles' : percentiles,
+            'field' : parsed['field']
+        }
+        format = negotiate(parsed['format'])
+        if format:
+            if not available(format):
+                return error_message('Format %s is not supported by this server' % format), 406
+            res = self.db.aggregate_frame(**dict(args), **options)
+            if res is None:
+                return error_message('Invalid Region \'%s\'' % args['region'])
+            return frame_response(res, format)
+        return self.db.aggregate(**dict(args), **options)
@@ -1,19 +1,89 @@
 import pandas as pd
-import geopandas as gpd
+import numpy as np
 import os
 import pickle
+import shutil
 import threading
 from threading import Lock
 import time
 import schedule
 import json
+import base64
+import binascii
 import polyline
 
-from shapely.geometry import Point, Polygon, shape
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from resources.obs.MountainHub import MountainHub
 from resources.obs.SnowPilot import SnowPilot
-from common.utils import empty_cso_dataframe, decoded_polygon, error_message, data_message
+from common.utils import empty_cso_dataframe, decoded_polygon, canonical_region, most_recent_hour, error_message, data_message, save_json, load_json, save_columns, load_columns
 from common.decorators import cache, threaded, locked
+from common.spatial import GridIndex, points_in_polygon
+
+# Numeric columns of on-disk segments, others are stored as strings
+SEGMENT_DTYPES = {
+    'timestamp' : 'int64',
+    'lat' : 'float64',
+    'long' : 'float64',
+    'snow_depth' : 'float64',
+    'elevation' : 'float64'
+}
+# Number of segments after which they are compacted into one
+MAX_SEGMENTS = 64
+# Records encoded at a time when streaming results
+STREAM_CHUNK = 5000
+# Time buckets of aggregations, in milliseconds or as calendar units
+INTERVALS = {
+    'hour' : 3600000,
+    'day' : 86400000,
+    'week' : 604800000,
+    'month' : 'M',
+    'year' : 'Y'
+}
+# Timestamp buckets of fixed length are counted from, 1970-01-05 (a Monday) so weeks start on Monday
+BUCKET_ORIGIN = 4 * 86400000
+# Statistics computed for every group of an aggregation
+STATISTICS = ['count', 'mean', 'min', 'max']
+
+def query_key(db, start, end, limit, page, region, source, cursor=''):
+    # Same polygon in any format shares an entry, and ends past the current
+    # hour are bucketed to it like the default end
+    return (db,), {
+        'start' : start,
+        'end' : min(end, most_recent_hour()),
+        'limit' : limit,
+        'page' : page,
+        'region' : canonical_region(region) if region else region,
+        'source' : source,
+        'cursor' : cursor
+    }
+
+def aggregate_key(db, start, end, region, source, interval='', cell_size=0, grid=None, by_source=False, percentiles=(), field='snow_depth'):
+    # Same normalization of filters as query_key
+    return (db,), {
+        'start' : start,
+        'end' : min(end, most_recent_hour()),
+        'region' : canonical_region(region) if region else region,
+        'source' : source,
+        'interval' : interval,
+        'cell_size' : cell_size,
+        'grid' : grid,
+        'by_source' : by_source,
+        'percentiles' : tuple(percentiles),
+        'field' : field
+    }
+
+def encode_cursor(timestamp, id):
+    """Get opaque token for continuing results after record."""
+    return base64.urlsafe_b64encode(json.dumps([int(timestamp), str(id)]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Get (timestamp, id) of record encoded in cursor, or None if invalid."""
+    try:
+        timestamp, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return int(timestamp), str(id)
+    except (ValueError, TypeError, binascii.Error):
+        return None
 
 class Obs_Database():
 
@@ -25,8 +95,12 @@ class Obs_Database():
         self.store_dir = store_dir
         self.state_path = os.path.join(self.store_dir, "state")
         self.df_path = os.path.join(self.store_dir, "df")
+        self.manifest_path = os.path.join(self.store_dir, "manifest")
+        self.segments_dir = os.path.join(self.store_dir, "segments")
+        self.pending = []
         self.df, self.state = self.load()
         self.df_lock = Lock()
+        self.build_index()
 
         self.sources = [MountainHub(), SnowPilot()]
         # Load state into sources
@@ -40,13 +114,27 @@ class Obs_Database():
         return self.load_df(), self.load_state()
 
     def load_df(self):
-        if os.path.exists(self.df_path):
+        columns = list(empty_cso_dataframe().columns)
+        self.manifest = load_json(self.manifest_path, { 'segments' : [], 'next' : 0 })
+        if not os.path.exists(self.segments_dir):
+            os.makedirs(self.segments_dir)
+        # Discard segments written but never committed to manifest
+        for name in os.listdir(self.segments_dir):
+            if name not in self.manifest['segments']:
+                shutil.rmtree(os.path.join(self.segments_dir, name))
+
+        if len(self.manifest['segments']) > 0:
+            segments = [load_columns(os.path.join(self.segments_dir, name), columns) for name in self.manifest['segments']]
+            return pd.concat(segments, ignore_index=True)
+        # Migrate frame pickled by older versions into first segment
+        elif os.path.exists(self.df_path):
             with open(self.df_path, 'rb') as df_file:
-                return pickle.load(df_file)
+                df = pickle.load(df_file)
+            self.pending.append(df)
+            return df
         else:
             return empty_cso_dataframe()
 
-
     def load_state(self):
         if os.path.exists(self.state_path):
             with open(self.state_path, 'rb') as state_file:
@@ -56,20 +144,67 @@ class Obs_Database():
                 'sources' : {}
             }
 
+    def build_index(self):
+        # Keep observations sorted by time so windows resolve by binary search
+        self.df = self.df.sort_values('timestamp', kind='mergesort').reset_index(drop=True)
+        self.timestamps = self.df['timestamp'].values.astype('int64')
+        self.ids = set(self.df['id'])
+        self.index = GridIndex()
+        self.index.insert(self.df['lat'].values, self.df['long'].values, np.arange(len(self.df)))
+
     def update_df(self, new_data):
-        self.df_lock.acquire()
-        self.df = pd.concat([self.df,new_data], sort=False).drop_duplicates('id').reset_index(drop=True)
-        self.df_lock.release()
+        with self.df_lock:
+            new_data = new_data[[id not in self.ids for id in new_data['id']]].drop_duplicates('id')
+            if len(new_data) > 0:
+                new_data = new_data.sort_values('timestamp', kind='mergesort')
+                new_timestamps = new_data['timestamp'].values.astype('int64')
+                # Positions in current frame before which each new row goes
+                inserts = np.searchsorted(self.timestamps, new_timestamps, side='right')
+                new_positions = inserts + np.arange(len(new_data))
+                df = pd.concat([self.df, new_data], sort=False)
+                if inserts[0] < len(self.df):
+                    old_positions = np.arange(len(self.df))
+                    old_positions += np.searchsorted(inserts, old_positions, side='right')
+                    order = np.empty(len(df), dtype='int64')
+                    order[old_positions] = np.arange(len(self.df))
+                    order[new_positions] = np.arange(len(self.df), len(df))
+                    df = df.iloc[order]
+                    self.index.shift(inserts)
+                self.df = df.reset_index(drop=True)
+                self.timestamps = np.insert(self.timestamps, inserts, new_timestamps)
+                self.ids.update(new_data['id'])
+                self.pending.append(new_data)
+                self.index.insert(new_data['lat'].values, new_data['long'].values, new_positions)
 
     def save(self):
         self.save_df()
         self.save_state()
 
     def save_df(self):
-        with open(self.df_path, 'wb') as df_file:
-            self.df_lock.acquire()
-            pickle.dump(self.df, df_file)
-            self.df_lock.release()
+        # Take rows merged since last save
+        self.df_lock.acquire()
+        pending, self.pending = self.pending, []
+        df = self.df
+        self.df_lock.release()
+        if len(pending) == 0:
+            return
+
+        segments = self.manifest['segments']
+        # Rewrite everything as one segment once there are too many
+        if len(segments) >= MAX_SEGMENTS:
+            rows, kept = df, []
+        else:
+            rows, kept = pd.concat(pending, sort=False), segments
+
+        name = '%08d' % self.manifest['next']
+        columns = list(empty_cso_dataframe().columns)
+        save_columns(rows.reindex(columns=columns), os.path.join(self.segments_dir, name), SEGMENT_DTYPES)
+        # Segment only becomes visible once manifest is replaced
+        self.manifest = { 'segments' : kept + [name], 'next' : self.manifest['next'] + 1 }
+        save_json(self.manifest, self.manifest_path)
+
+        for old in set(segments) - set(kept):
+            shutil.rmtree(os.path.join(self.segments_dir, old))
 
     def save_state(self):
         with open(self.state_path, 'wb') as state_file:
@@ -78,16 +213,56 @@ class Obs_Database():
             pickle.dump(self.state, state_file)
 
     def get_new_data(self):
+        windows = { source.key : source.new_windows() for source in self.sources }
+        failed = self.fetch_windows(windows)
+        # Only move past windows once all of them are in frame
         for source in self.sources:
-            for block in source.get_new_data():
-                self.update_df(block)
-            self.save()
+            if source.key not in failed and len(windows[source.key]) > 0:
+                source.state['max_timestamp'] = windows[source.key][-1][1]
+        self.save()
 
     def get_all_data(self):
+        # Only windows due for a check are fetched, and only changed ones are merged
+        failed = self.fetch_windows({ source.key : source.reconcile_windows() for source in self.sources }, reconcile=True)
+        # Failed windows keep their old fingerprints until they are fetched again
         for source in self.sources:
-            for block in source.get_all_data():
-                self.update_df(block)
-                self.save()
+            if source.key not in failed:
+                source.merge_windows()
+        self.save()
+
+    def fetch_windows(self, windows, reconcile=False):
+        """Fetch windows of all sources concurrently, merging each block into
+        frame from this thread as soon as it arrives. Fingerprints of
+        reconciled windows are only committed once their block is merged.
+        Returns keys of sources with windows that failed.
+
+        Keyword arguments:
+        windows -- Dictionary of source key to list of windows to fetch
+        reconcile -- Whether to skip windows unchanged since last reconcile
+        """
+        # Each source has its own pool, limiting requests to it
+        pools = { source.key : ThreadPoolExecutor(max_workers=source.max_workers) for source in self.sources }
+        futures = {}
+        for source in self.sources:
+            for window in windows.get(source.key, []):
+                futures[pools[source.key].submit(source.fetch, window, reconcile)] = source
+
+        failed = set()
+        try:
+            for future in as_completed(futures):
+                source = futures[future]
+                try:
+                    block, fingerprints = future.result()
+                    self.update_df(block)
+                except Exception as e:
+                    print(e)
+                    failed.add(source.key)
+                    continue
+                source.commit_fingerprints(fingerprints)
+        finally:
+            for pool in pools.values():
+                pool.shutdown()
+        return failed
 
     @threaded
     def run_worker(self):
@@ -97,24 +272,200 @@ class Obs_Database():
             schedule.run_pending()
             time.sleep(60)
 
-    @cache(ttl=60, max_size = 128)
-    def query(self, start, end, limit, page, region, source):
-        # Restrict by time
+    def select(self, start, end, region, source, after=None):
+        """Get (df, lo, hi, positions) of records matching filters, where
+        positions are sorted positions of matching rows of df, or None if all
+        rows in [lo, hi) match. Returns None if region is invalid.
+
+        Keyword arguments:
+        start -- Earliest unix timestamp (in milliseconds), exclusive
+        end -- Latest unix timestamp (in milliseconds), exclusive
+        region -- Encoded polygon or coordinate string, unrestricted if empty
+        source -- Name of source, any source if empty
+        after -- (timestamp, id) of record to return records after, if any
+        """
+        # Decode region before touching data
+        if region:
+            polygon = decoded_polygon(region)
+            if polygon is None:
+                return None
+        # Snapshot frame, frame is replaced rather than modified by updates
         self.df_lock.acquire()
-        df = self.df[(self.df.timestamp > start) & (self.df.timestamp < end)]
+        df = self.df
+        timestamps = self.timestamps
+        positions = self.index.candidates(polygon.bounds) if region else None
         self.df_lock.release()
-        if source:
-            df = df[df.source == source]
+        # Restrict by time
+        lo = np.searchsorted(timestamps, start, side='right')
+        hi = np.searchsorted(timestamps, end, side='left')
+        if after is not None:
+            lo = max(lo, self.position_after(df, timestamps, *after))
+        hi = max(lo, hi)
         # Restrict by region
-        if region:
-            try:
-                polygon = gpd.GeoSeries(decoded_polygon(region), crs={'init': 'epsg:4326'})
-                locations = gpd.GeoSeries([Point(coord) for coord in zip(df['long'], df['lat'])], crs={'init': 'epsg:4326'})
-                df = df[locations.intersects(polygon.ix[0])]
-            except:
-                return error_message('Invalid Region \'%s\'' % region)
-        # Limit number of results
-        df = df[((page - 1) * limit):page * limit]
-
-        res_str = df.to_json(orient='records')
-        return data_message(json.loads(res_str))
+        if positions is not None:
+            positions = positions[np.searchsorted(positions, lo):np.searchsorted(positions, hi)]
+            candidates = df.iloc[positions]
+            positions = positions[points_in_polygon(candidates['long'].values, candidates['lat'].values, polygon)]
+        # Restrict by source
+        if source:
+            if positions is None:
+                positions = lo + np.flatnonzero(df['source'].values[lo:hi] == source)
+            else:
+                positions = positions[df['source'].values[positions] == source]
+        return df, lo, hi, positions
+
+    def position_after(self, df, timestamps, timestamp, id):
+        # Records with same timestamp are kept in order of arrival, so
+        # position after record stays the same while new records are merged
+        first = np.searchsorted(timestamps, timestamp, side='left')
+        stop = np.searchsorted(timestamps, timestamp, side='right')
+        match = np.flatnonzero(df['id'].values[first:stop] == id)
+        return first + match[0] + 1 if len(match) > 0 else stop
+
+    def select_page(self, start, end, limit, page, region, source, cursor=''):
+        """Get (df, rows, next) of page of records, where rows are positions
+        of records in df (as slice or array) and next is cursor continuing
+        after page, or None if there are no more records. Page is ignored if
+        cursor is set. Returns None if region or cursor is invalid.
+
+        Keyword arguments:
+        limit -- Maximum number of records, unlimited if None
+        cursor -- Token returned with previous page, if any
+        """
+        after = None
+        if cursor:
+            after = decode_cursor(cursor)
+            if after is None:
+                return None
+        selection = self.select(start, end, region, source, after)
+        if selection is None:
+            return None
+        df, lo, hi, positions = selection
+        # Cursor takes the place of page
+        offset = (page - 1) * limit if limit is not None and not cursor else 0
+        count = (hi - lo) if positions is None else len(positions)
+        first, stop = min(count, offset), count if limit is None else min(count, offset + limit)
+        rows = slice(lo + first, lo + stop) if positions is None else positions[first:stop]
+        next = None
+        if stop < count and stop > first:
+            last = lo + stop - 1 if positions is None else positions[stop - 1]
+            next = encode_cursor(df['timestamp'].values[last], df['id'].values[last])
+        return df, rows, next
+
+    @cache(ttl=60, max_size = 128, normalize = query_key)
+    def query(self, start, end, limit, page, region, source, cursor=''):
+        selection = self.select_page(start, end, limit, page, region, source, cursor)
+        if selection is None:
+            return self.invalid(region, cursor)
+        df, rows, next = selection
+
+        res_str = df.iloc[rows].to_json(orient='records')
+        return { **data_message(json.loads(res_str)), 'next' : next }
+
+    def invalid(self, region, cursor):
+        if cursor and decode_cursor(cursor) is None:
+            return error_message('Invalid Cursor \'%s\'' % cursor)
+        return error_message('Invalid Region \'%s\'' % region)
+
+    def query_frame(self, start, end, limit, page, region, source, cursor=''):
+        """Get (df, next) of page of records, or None if region or cursor is
+        invalid.
+
+        Keyword arguments:
+        limit -- Maximum number of records, unlimited if 0
+        """
+        selection = self.select_page(start, end, limit if limit > 0 else None, page, region, source, cursor)
+        if selection is None:
+            return None
+        df, rows, next = selection
+        return df.iloc[rows], next
+
+    def query_stream(self, start, end, limit, page, region, source, cursor='', lines=False):
+        """Get (chunks, next) where chunks is generator of JSON text of page of
+        records, encoded in chunks straight from frame, and next is as in
+        select_page. Returns None if region or cursor is invalid. Records are
+        written as {"data": [...]} like query, or one per line if lines is set.
+
+        Keyword arguments:
+        limit -- Maximum number of records, unlimited if 0
+        lines -- Whether to write newline-delimited JSON
+        """
+        selection = self.select_page(start, end, limit if limit > 0 else None, page, region, source, cursor)
+        if selection is None:
+            return None
+        df, rows, next = selection
+        count = rows.stop - rows.start if isinstance(rows, slice) else len(rows)
+        first = rows.start if isinstance(rows, slice) else 0
+
+        def generate():
+            if not lines:
+                yield '{"data": ['
+            for i in range(0, count, STREAM_CHUNK):
+                j = min(count, i + STREAM_CHUNK)
+                chunk = df.iloc[first + i:first + j] if isinstance(rows, slice) else df.iloc[rows[i:j]]
+                if lines:
+                    yield chunk.to_json(orient='records', lines=True).rstrip('\n') + '\n'
+                else:
+                    # Strip brackets of chunk array, chunks are joined into one array
+                    yield (',' if i > 0 else '') + chunk.to_json(orient='records')[1:-1]
+            if not lines:
+                yield '], "next": %s}' % json.dumps(next)
+        return generate(), next
+
+    def aggregate_frame(self, start, end, region, source, interval='', cell_size=0, grid=None, by_source=False, percentiles=(), field='snow_depth'):
+        """Get statistics of field of records matching filters as dataframe,
+        with one row per group. Returns None if region is invalid.
+
+        Records are grouped by any combination of time bucket, spatial bin
+        and source. Groups are labelled by the start of their time bucket and
+        the center of their bin.
+
+        Keyword arguments:
+        start, end, region, source -- Filters, as in select
+        interval -- Name of time bucket in INTERVALS, not grouped by time if empty
+        cell_size -- Size of square bins in degrees, not grouped spatially if 0
+        grid -- SNODAS_Grid whose cells are used as bins instead of cell_size
+        by_source -- Whether to group by source
+        percentiles -- Percentiles (0 to 100) to compute besides STATISTICS
+        field -- Numeric column to compute statistics of
+        """
+        selection = self.select(start, end, region, source)
+        if selection is None:
+            return None
+        df, lo, hi, positions = selection
+        rows = df.iloc[lo:hi] if positions is None else df.iloc[positions]
+        lat, long = rows['lat'].values.astype('float64'), rows['long'].values.astype('float64')
+        keep = np.ones(len(rows), dtype=bool)
+
+        keys = {}
+        if interval:
+            timestamps = rows['timestamp'].values.astype('int64')
+            unit = INTERVALS[interval]
+            if isinstance(unit, str):
+                keys['timestamp'] = timestamps.astype('datetime64[ms]').astype('datetime64[%s]' % unit).astype('datetime64[ms]').astype('int64')
+            else:
+                keys['timestamp'] = (timestamps - BUCKET_ORIGIN) // unit * unit + BUCKET_ORIGIN
+        if grid is not None:
+            cell_rows, cell_cols, keep = grid.indices(lat, long)
+            keys['lat'], keys['long'] = grid.center(cell_rows, cell_cols)
+        elif cell_size > 0:
+            keys['lat'] = (np.floor(lat / cell_size) + 0.5) * cell_size
+            keys['long'] = (np.floor(long / cell_size) + 0.5) * cell_size
+        if by_source:
+            keys['source'] = rows['source'].values
+
+        groups = pd.DataFrame({ **keys, 'value' : rows[field].values.astype('float64') })[keep]
+        # Without keys every record is in one group
+        by = list(keys) if len(keys) > 0 else np.zeros(len(groups), dtype='int64')
+        grouped = groups.groupby(by, sort=True)['value']
+        res = grouped.agg(STATISTICS)
+        for percentile in percentiles:
+            res['p%g' % percentile] = grouped.quantile(percentile / 100)
+        return res.reset_index(drop=len(keys) == 0)
+
+    @cache(ttl=60, max_size = 128, normalize = aggregate_key)
+    def aggregate(self, start, end, region, source, interval='', cell_size=0, grid=None, by_source=False, percentiles=(), field='snow_depth'):
+        res = self.aggregate_frame(start, end, region, source, interval, cell_size, grid, by_source, percentiles, field)
+        if res is None:
+            return error_message('Invalid Region \'%s\'' % region)
+        return data_message(json.loads(res.to_json(orient='records')))
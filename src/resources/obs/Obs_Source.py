@@ -0,0 +1,188 @@
+import time
+import json
+import hashlib
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from threading import Lock
+
+import pandas as pd
+
+from common.utils import empty_cso_dataframe
+from common.elevation import with_elevation
+
+ONE_DAY = 86400000
+ONE_MONTH = 2592000000
+# Longest wait between reconciles of a window that keeps not changing
+MAX_RECHECK_DAYS = 32
+# Adjacent windows are merged while they hold less than this fraction of a page together
+SPARSE_FRACTION = 0.25
+# Longest window made by merging sparse windows
+MAX_WINDOW = 12 * ONE_MONTH
+
+def fingerprint(records):
+    """Get count and hash of records, independent of their order. Hashes of
+    disjoint sets of records combine with combine_fingerprints.
+
+    Keyword arguments:
+    records -- List of parsed records
+    """
+    digest = 0
+    for record in records:
+        digest ^= int(hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest(), 16)
+    return [len(records), '%040x' % digest]
+
+def combine_fingerprints(first, second):
+    """Get fingerprint of union of records of two disjoint windows."""
+    return [first[0] + second[0], '%040x' % (int(first[1], 16) ^ int(second[1], 16))]
+
+class Obs_Source(ABC):
+    """Source of observations fetched in time windows.
+
+    Subclasses set key and state, page_limit (most results returned by one
+    request) and min_window, and implement fetch_records. Windows returning
+    a full page are split until results fit. The resulting window
+    boundaries are kept in state, and sparse neighbouring windows are merged
+    again, so each reconcile makes about as few requests as possible.
+
+    Fingerprints of windows fetched during reconciles are also kept in
+    state, so windows that did not change are not processed again, and are
+    checked less often the longer they stay unchanged.
+    """
+
+    max_workers = 1
+    page_limit = 1000
+    min_window = ONE_DAY
+
+    def __init__(self):
+        self.state_lock = Lock()
+
+    def new_windows(self):
+        """Get (min_timestamp, max_timestamp) windows of data added since last fetch."""
+        if ('max_timestamp' in self.state):
+            return self.windows(self.state['max_timestamp'])
+        return []
+
+    def all_windows(self):
+        """Get (min_timestamp, max_timestamp) windows of all data, using the
+        boundaries of earlier reconciles."""
+        if ('min_timestamp' not in self.state):
+            return []
+        now = int(time.time() * 1000)
+        with self.state_lock:
+            boundaries = self.state.setdefault('boundaries', [self.state['min_timestamp']])
+            # Time since last reconcile starts as month windows
+            while boundaries[-1] + ONE_MONTH < now:
+                boundaries.append(self.align(boundaries[-1] + ONE_MONTH))
+            return list(zip(boundaries, boundaries[1:] + [now]))
+
+    def reconcile_windows(self):
+        """Get windows of all data that are due to be checked for changes."""
+        now = int(time.time() * 1000)
+        windows = self.all_windows()
+        with self.state_lock:
+            checks = self.state.get('windows', {})
+            return [window for window in windows if checks.get(str(window[0]), {}).get('next_check', 0) <= now]
+
+    def windows(self, timestamp):
+        now = int(time.time() * 1000)
+        windows = []
+        while timestamp < now:
+            end = min(self.align(timestamp + ONE_MONTH), now)
+            windows.append((timestamp, end))
+            timestamp = end
+        return windows
+
+    def align(self, timestamp):
+        """Get boundary at or before timestamp that windows may be split at.
+        Sources querying by whole days override this, so that neighbouring
+        windows never share a day."""
+        return timestamp
+
+    def fetch(self, window, reconcile=False):
+        """Get (df, fingerprints) of (min_timestamp, max_timestamp) window,
+        where fingerprints are passed to commit_fingerprints once df is merged.
+
+        Keyword arguments:
+        window -- Tuple of (min_timestamp, max_timestamp)
+        reconcile -- Whether window is one of all_windows, in which case an
+            empty dataframe is returned if it has not changed since it was
+            last reconciled
+        """
+        parts = self.fetch_complete(*window)
+        records = [record for part, part_records in parts for record in part_records]
+        fingerprints = [(part, fingerprint(part_records)) for part, part_records in parts] if reconcile else []
+        if reconcile and not self.changed(fingerprints):
+            return empty_cso_dataframe(), fingerprints
+
+        records = with_elevation(records)
+        if len(records) == 0:
+            return empty_cso_dataframe(), fingerprints
+        return pd.DataFrame.from_records(records), fingerprints
+
+    def fetch_complete(self, min_timestamp, max_timestamp):
+        """Get list of (window, records) covering window, splitting it while
+        results fill a page and could be truncated."""
+        records, count = self.fetch_records(min_timestamp, max_timestamp)
+        middle = self.align((min_timestamp + max_timestamp) // 2)
+        if count < self.page_limit or max_timestamp - min_timestamp < 2 * self.min_window \
+                or not min_timestamp < middle < max_timestamp:
+            if count >= self.page_limit:
+                print('%s results from %d to %d may be truncated' % (self.key, min_timestamp, max_timestamp))
+            return [((min_timestamp, max_timestamp), records)]
+        return self.fetch_complete(min_timestamp, middle) + self.fetch_complete(middle, max_timestamp)
+
+    def changed(self, fingerprints):
+        # Whether any part differs from when it was last reconciled
+        with self.state_lock:
+            checks = self.state.get('windows', {})
+            return any(checks.get(str(part[0]), {}).get('fingerprint') != current for part, current in fingerprints)
+
+    def commit_fingerprints(self, fingerprints):
+        """Record boundaries and fingerprints of parts of a reconciled window,
+        and when each should next be checked. Called only once the window is
+        merged, so a window that failed is fetched again at next reconcile.
+
+        Keyword arguments:
+        fingerprints -- List of (window, fingerprint) returned by fetch
+        """
+        now = int(time.time() * 1000)
+        with self.state_lock:
+            boundaries = self.state.setdefault('boundaries', [self.state['min_timestamp']])
+            checks = self.state.setdefault('windows', {})
+            for (min_timestamp, max_timestamp), current in fingerprints:
+                index = bisect_left(boundaries, min_timestamp)
+                if index == len(boundaries) or boundaries[index] != min_timestamp:
+                    boundaries.insert(index, min_timestamp)
+                check = checks.get(str(min_timestamp), {})
+                unchanged = check.get('unchanged', -1) + 1 if check.get('fingerprint') == current else 0
+                # Window still growing is checked every time
+                delay = 0 if max_timestamp >= now - ONE_DAY else ONE_DAY * min(2 ** unchanged, MAX_RECHECK_DAYS) - ONE_DAY // 2
+                checks[str(min_timestamp)] = { 'fingerprint' : current, 'unchanged' : unchanged, 'next_check' : now + delay }
+
+    def merge_windows(self):
+        """Merge neighbouring reconciled windows that together hold few records."""
+        now = int(time.time() * 1000)
+        with self.state_lock:
+            boundaries = self.state.get('boundaries', [])
+            checks = self.state.get('windows', {})
+            merged = boundaries[:1]
+            for start, end in zip(boundaries[1:], boundaries[2:] + [now]):
+                first, second = checks.get(str(merged[-1])), checks.get(str(start))
+                # Window still growing is kept apart, as is anything not fetched yet
+                if end < now - ONE_DAY and first is not None and second is not None \
+                        and first['fingerprint'][0] + second['fingerprint'][0] < SPARSE_FRACTION * self.page_limit \
+                        and end - merged[-1] <= MAX_WINDOW:
+                    checks[str(merged[-1])] = {
+                        'fingerprint' : combine_fingerprints(first['fingerprint'], second['fingerprint']),
+                        'unchanged' : min(first['unchanged'], second['unchanged']),
+                        'next_check' : min(first['next_check'], second['next_check'])
+                    }
+                    del checks[str(start)]
+                else:
+                    merged.append(start)
+            self.state['boundaries'] = merged
+
+    @abstractmethod
+    def fetch_records(self, min_timestamp, max_timestamp):
+        """Get (records, count) of window, where records are parsed records
+        without elevation and count is number of results before parsing."""
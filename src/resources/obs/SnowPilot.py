@@ -10,9 +10,9 @@ from lxml import etree
 import time
 
 from flask_restful import fields, marshal, reqparse, Resource, inputs
-from common.utils import empty_cso_dataframe, timestamp_to_date
-from common.elevation import with_elevation
+from common.utils import timestamp_to_date, date_to_timestamp
 from common.decorators import unsafe, cache
+from resources.obs.Obs_Source import Obs_Source, ONE_DAY
 
 LOGIN_URL = 'https://snowpilot.org/user/login'
 LOGIN_HEADERS = { 'User-Agent': 'script login' }
@@ -21,11 +21,20 @@ HEADER = {
     'Content-Disposition': 'attachment; filename="query-results.xml"',
     'Content-Type': 'application/xml'
 }
-ONE_MONTH = 2592000000
+# Windows fetched from SnowPilot at once
+MAX_WORKERS = 2
+# Most results returned for one request
+PAGE_LIMIT = 1000
 
-class SnowPilot():
+class SnowPilot(Obs_Source):
+
+    max_workers = MAX_WORKERS
+    page_limit = PAGE_LIMIT
+    # Queries are by date, shorter windows would return the same results
+    min_window = ONE_DAY
 
     def __init__(self):
+        super().__init__()
         self.key = "SnowPilot"
         self.state = { 'min_timestamp': 1476705600000, 'max_timestamp': 1476705600000 }
         self.cookies = self.get_cookies()
@@ -40,25 +49,6 @@ class SnowPilot():
         r = requests.post(LOGIN_URL, data = post_data, headers=LOGIN_HEADERS)
         return r.history[0].cookies
 
-    def get_new_data(self):
-        if ('max_timestamp' in self.state):
-            ts = self.state['max_timestamp']
-            for block in self.__get_data(ts):
-                yield block
-            self.state['max_timestamp'] = int(time.time() * 1000)
-
-    def get_all_data(self):
-        if ('min_timestamp' in self.state):
-            ts = self.state['min_timestamp']
-            for block in self.__get_data(ts):
-                yield block
-
-    def __get_data(self, timestamp):
-        while timestamp < int(time.time() * 1000):
-            block = self.__fetch_raw_data(timestamp, min(timestamp + ONE_MONTH, int(time.time() * 1000)))
-            yield block
-            timestamp += ONE_MONTH
-
     @unsafe
     def __parse_data(self, record):
 
@@ -78,9 +68,14 @@ class SnowPilot():
 
         return marshal(dict, cso_format)
 
-    def __fetch_raw_data(self, min_timestamp, max_timestamp):
+    def align(self, timestamp):
+        # Windows are split at midnight, as queries cover whole days
+        return date_to_timestamp(timestamp_to_date(timestamp).replace(hour=0, minute=0, second=0, microsecond=0))
+
+    def fetch_records(self, min_timestamp, max_timestamp):
+        # Query dates are inclusive, a window ending at midnight leaves that day to the next window
         date_min = timestamp_to_date(min_timestamp).strftime('%Y-%m-%d')
-        date_max = timestamp_to_date(max_timestamp).strftime('%Y-%m-%d')
+        date_max = timestamp_to_date(max_timestamp - 1).strftime('%Y-%m-%d')
 
         args = {
             'LOC_NAME': '',
@@ -88,35 +83,16 @@ class SnowPilot():
             'OBS_DATE_MAX': date_max,
             'USERNAME': '',
             'AFFIL': '',
-            'per_page': '1000',
+            'per_page': str(PAGE_LIMIT),
             'submit': 'Get Pits'
         }
 
         response = requests.get(BASE_URL, params=args, headers=HEADER, cookies=self.cookies)
-        if response.status_code == 200:
-            try:
-                xml = etree.XML(response.text.replace('<?xml version="1.0" encoding="UTF-8"?>\n', ''))
-                results = xml.getchildren()
-                all_results = [ self.__parse_data(result) for result in results]
-                valid_results = [result for result in all_results if result is not None]
-                valid_results = with_elevation(valid_results)
-                if len(valid_results) > 0:
-                    df = pd.DataFrame.from_records(valid_results)
-                    return df
-            except Exception as e:
-                print(e)
-
-        return empty_cso_dataframe()
-
-        if 'results' not in data or len(data['results']) == 0:
-            return empty_cso_dataframe()
-        else:
-            results = data['results']
-            all_results = [ self.__parse_data(result) for result in results ]
-            valid_results = [result for result in all_results if result is not None]
-            valid_results = with_elevation(valid_results)
-            if len(valid_results) == 0:
-                return empty_cso_dataframe()
-
-            df = pd.DataFrame.from_records(valid_results)
-            return df
+        # Failures are raised so window is fetched again rather than recorded as empty
+        if response.status_code != 200:
+            raise ValueError('SnowPilot returned status %d' % response.status_code)
+        xml = etree.XML(response.text.replace('<?xml version="1.0" encoding="UTF-8"?>\n', ''))
+        results = xml.getchildren()
+        all_results = [ self.__parse_data(result) for result in results]
+        valid_results = [result for result in all_results if result is not None]
+        return valid_results, len(results)
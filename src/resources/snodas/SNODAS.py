@@ -4,22 +4,28 @@ import math
 
 from flask_restful import fields, marshal, reqparse, Resource, inputs
 from datetime import datetime
-from common.utils import most_recent_hour
+from common.utils import most_recent_hour, error_message
 from common.elevation import with_elevation
+from common.formats import FORMATS, negotiate, available, frame_response
+from resources.snodas.SNODAS_Database import PRODUCTS, DEFAULT_PRODUCT
 
-parser = reqparse.RequestParser(bundle_errors=True)
-parser.add_argument('lat', type=float, required=True)
-parser.add_argument('long', type=float, required=True)
+# Maximum number of points in one batch request
+MAX_POINTS = 1000
 
-args_format = {
-    'lat' : fields.Float(),
-    'long' : fields.Float()
-}
+parser = reqparse.RequestParser(bundle_errors=True)
+parser.add_argument('lat', type=float, required=True, action='append', location='args')
+parser.add_argument('long', type=float, required=True, action='append', location='args')
+parser.add_argument('start', type=int, location='args')
+parser.add_argument('end', type=int, location='args')
+parser.add_argument('product', type=str, default=DEFAULT_PRODUCT, choices=list(PRODUCTS), location='args')
+parser.add_argument('format', type=str, default='', choices=['', 'json'] + list(FORMATS), location='args')
 
-args_format = {
-    'lat' : fields.Float(),
-    'long' : fields.Float()
-}
+batch_parser = reqparse.RequestParser(bundle_errors=True)
+batch_parser.add_argument('points', type=dict, required=True, action='append', location='json')
+batch_parser.add_argument('start', type=int, location='json')
+batch_parser.add_argument('end', type=int, location='json')
+batch_parser.add_argument('product', type=str, default=DEFAULT_PRODUCT, choices=list(PRODUCTS), location='json')
+batch_parser.add_argument('format', type=str, default='', choices=['', 'json'] + list(FORMATS), location='json')
 
 class SNODAS(Resource):
 
@@ -27,5 +33,40 @@ class SNODAS(Resource):
         self.db = db
 
     def get(self):
-        args = marshal(parser.parse_args(), args_format)
-        return self.db.query(**dict(args))
+        args = parser.parse_args()
+        if len(args['lat']) != len(args['long']):
+            return error_message('Number of lat and long values must match'), 400
+        points = list(zip(args['lat'], args['long']))
+        format = negotiate(args['format'])
+        if format:
+            return self.frame(points, args['start'], args['end'], args['product'], format)
+        # Single point keeps returning a plain time series
+        if len(points) == 1:
+            return self.db.query(lat=points[0][0], long=points[0][1], start=args['start'], end=args['end'], product=args['product'])
+        return self.batch(points, args['start'], args['end'], args['product'])
+
+    def post(self):
+        args = batch_parser.parse_args()
+        try:
+            points = [(float(point['lat']), float(point['long'])) for point in args['points']]
+        except (KeyError, TypeError, ValueError):
+            return error_message('Points must have numeric lat and long'), 400
+        format = negotiate(args['format'])
+        if format:
+            return self.frame(points, args['start'], args['end'], args['product'], format)
+        return self.batch(points, args['start'], args['end'], args['product'])
+
+    def batch(self, points, start, end, product):
+        if len(points) > MAX_POINTS:
+            return error_message('At most %d points can be requested at once' % MAX_POINTS), 400
+        return self.db.query_batch(points, start=start, end=end, product=product)
+
+    def frame(self, points, start, end, product, format):
+        if len(points) > MAX_POINTS:
+            return error_message('At most %d points can be requested at once' % MAX_POINTS), 400
+        if not available(format):
+            return error_message('Format %s is not supported by this server' % format), 406
+        df = self.db.query_frame(points, start=start, end=end, product=product)
+        if df is None:
+            return error_message('No available data')
+        return frame_response(df, format)
@@ -0,0 +1,104 @@
+import os
+from collections import OrderedDict
+from threading import Lock, get_ident
+
+class SNODAS_Cache():
+    """On-disk cache of downloaded SNODAS archives and decoded grids.
+
+    Files are named by date (and product code for grids). Once the cache
+    holds more than max_bytes, least recently used files are removed, except
+    for the most recently added one. Recency is kept in file modification
+    times, so it survives restarts.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        # Name to size of cached files, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        if os.path.exists(cache_dir):
+            self.scan()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def scan(self):
+        # Discard files left by interrupted writes, order the rest by last use
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            else:
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    @staticmethod
+    def archive_name(date):
+        return date.strftime('%Y%m%d.tar')
+
+    @staticmethod
+    def grid_name(date, code):
+        return '%s_%d.npz' % (date.strftime('%Y%m%d'), code)
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def open(self, name):
+        """Get open binary file of cached entry, or None if not cached.
+
+        Keyword arguments:
+        name -- Name of entry
+        """
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+            path = self.path(name)
+            os.utime(path)
+            return open(path, 'rb')
+
+    def put(self, name, write):
+        """Add entry to cache, evicting least recently used entries if cache
+        grows over its size.
+
+        Keyword arguments:
+        name -- Name of entry
+        write -- Function writing contents of entry to the binary file passed to it
+        """
+        if not self.enabled:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(name)
+        # Concurrent writers of the same entry each use their own temporary file
+        tmp_path = '%s.%d.tmp' % (path, get_ident())
+        try:
+            with open(tmp_path, 'wb') as file:
+                write(file)
+        except:
+            os.remove(tmp_path)
+            raise
+        size = os.path.getsize(tmp_path)
+
+        with self.lock:
+            os.replace(tmp_path, path)
+            self.size += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.evict()
+
+    def evict(self):
+        # Must be called with lock held
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
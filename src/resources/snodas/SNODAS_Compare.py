@@ -0,0 +1,43 @@
+import json
+
+from flask_restful import fields, marshal, reqparse, Resource, inputs
+from common.utils import most_recent_hour, error_message, data_message
+from common.formats import FORMATS, negotiate, available, frame_response
+from resources.obs.Obs import parser, args_format
+
+class SNODAS_Compare(Resource):
+    """Observations paired with SNODAS snow depth of their cell and day.
+
+    Takes the same parameters as /obs except stream, and adds snodas_depth and residual
+    (observed minus SNODAS depth, in centimeters) to each record.
+    """
+
+    def __init__(self, obs_db, snodas_db):
+        self.obs_db = obs_db
+        self.snodas_db = snodas_db
+
+    def get(self):
+        parsed = parser.parse_args()
+        if parsed['stream']:
+            return error_message('Streaming is not supported by /compare'), 400
+        args = marshal(parsed, args_format)
+        args['end'] = args['end'] or most_recent_hour()
+        format = negotiate(parsed['format'])
+        if format and not available(format):
+            return error_message('Format %s is not supported by this server' % format), 406
+
+        selection = self.obs_db.query_frame(**dict(args))
+        if selection is None:
+            return self.obs_db.invalid(args['region'], args['cursor'])
+        df, next = selection
+        depths = self.snodas_db.gather(df['lat'].values, df['long'].values, df['timestamp'].values)
+        if depths is None:
+            return error_message('No available data')
+        df = df.assign(snodas_depth=depths, residual=df['snow_depth'].values.astype('float64') - depths)
+
+        if format:
+            response = frame_response(df, format)
+            if next is not None:
+                response.headers['X-Next-Cursor'] = next
+            return response
+        return { **data_message(json.loads(df.to_json(orient='records'))), 'next' : next }
@@ -1,6 +1,8 @@
 import pandas as pd
+import numpy as np
 import geopandas as gpd
 import os
+import re
 import pickle
 import threading
 from threading import Lock
@@ -8,16 +10,42 @@ import time
 import schedule
 import json
 import xarray as xr
-import subprocess
 
-from shutil import copy2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from common.utils import empty_cso_dataframe, error_message, data_message
-from common.decorators import cache, threaded, locked, unsafe
+from common.decorators import cache, threaded, locked, unsafe, LRUCache
 import common.utils as ut
 import resources.snodas.SNODAS_Retrieve as SNODAS_Retrieve
+from resources.snodas.SNODAS_Store import SNODAS_Store
+from resources.snodas.SNODAS_Grid import SNODAS_Grid
+from resources.snodas.SNODAS_Generation import SNODAS_Generation
 
-# TODO - Uandle switching database in consistency check
+# Products ingested, by name used in API: (SNODAS product code, divisor from stored value to reported units)
+PRODUCTS = {
+    'snow_depth' : (1036, 10),
+    'swe' : (1034, 10),
+}
+DEFAULT_PRODUCT = 'snow_depth'
+# First day ingested into a new store
+MIN_DATE = datetime(2018,1,1)
+# Days appended to store before they are compacted into a new pixel-major block of series
+SERIES_BLOCK_DAYS = 30
+# Approximate bytes of block copied at a time while compacting
+SERIES_BAND_BYTES = 64 * 1024 * 1024
+# Days downloaded and decoded concurrently during backfill
+BACKFILL_WORKERS = 4
+# Days prepared ahead of the one being appended, each holds one decoded grid
+BACKFILL_IN_FLIGHT = 8
+
+def query_key(db, lat, long, start=None, end=None, product=DEFAULT_PRODUCT):
+    # Points in the same grid cell share an entry
+    generation = db.generations.get(product)
+    cell = generation.grid.index(lat, long) if generation is not None else None
+    if cell is not None:
+        lat, long = generation.grid.center(*cell)
+    return (db,), { 'lat' : lat, 'long' : long, 'start' : start, 'end' : end, 'product' : product }
 
 class SNODAS_Database():
 
@@ -27,142 +55,269 @@ class SNODAS_Database():
             os.makedirs(store_dir)
 
         self.store_dir = store_dir
-        self.state_path = os.path.join(self.store_dir, "state")
-        self.nc_path_1 = os.path.join(self.store_dir, "db_1.nc")
-        self.nc_path_2 = os.path.join(self.store_dir, "db_2.nc")
-
-        self.state = self.load()
-        if 'last_updated' in self.state and self.state['last_updated'] is not None:
-            self.ds = xr.open_dataset(self.state['last_updated'])
-        else:
-            self.ds = None
-        self.ds_lock = Lock()
+        # Each product has its own store, as days of products can be added at different times
+        self.stores = { product : SNODAS_Store(os.path.join(store_dir, product)) for product in PRODUCTS }
+        self.generations = {}
+        # Serialized results by (product, row, col, start, end), shared by batch queries
+        self.cells = LRUCache(ttl=10, max_size=4096)
+        self.migrate()
+        for product, store in self.stores.items():
+            if store.days > 0:
+                self.publish(product)
         self.get_data_test()
 
-    def load(self):
-        if os.path.exists(self.state_path):
-            with open(self.state_path, 'rb') as state_file:
-                return pickle.load(state_file)
-        else:
-            return {
-                'min_date' : datetime(2018,1,1),
-                'max_date_1' : None,
-                'max_date_2' : None,
-                'last_updated' : None,
-            }
-
-    def save(self):
-        with open(self.state_path, 'wb') as state_file:
-            pickle.dump(self.state, state_file)
+    def migrate(self):
+        """Copy days from NetCDF store of older versions into journaled store,
+        then remove the NetCDF store."""
+        store = self.stores[DEFAULT_PRODUCT]
+        state_path = os.path.join(self.store_dir, "state")
+        if not os.path.exists(state_path):
+            return
+        with open(state_path, 'rb') as state_file:
+            state = pickle.load(state_file)
+
+        if state.get('last_updated') is not None:
+            ds = xr.open_dataset(state['last_updated'], mask_and_scale=False)
+            band = ds.Band1.transpose('time', 'lat', 'lon')
+            lat, lon = ds.lat.values, ds.lon.values
+            # Stores made by GDAL have latitudes increasing, flip rows to north-up
+            flip = lat[0] < lat[-1]
+            if flip:
+                lat = lat[::-1]
+            lat_step, lon_step = lat[1] - lat[0], lon[1] - lon[0]
+            transform = (lon[0] - lon_step / 2, lon_step, 0, lat[0] - lat_step / 2, 0, lat_step)
+            ndv = band.attrs.get('_FillValue', -9999)
+            # Days committed before an interrupted migration are not copied again
+            for index in range(store.days, len(ds.time)):
+                array = band.isel(time=index).values
+                store.append(pd.Timestamp(ds.time.values[index]).to_pydatetime(), array[::-1] if flip else array, transform, int(ndv))
+            ds.close()
+
+        # Every day is committed to journaled store, state goes last so removal resumes if interrupted
+        names = ['db_1.nc', 'db_2.nc'] + [name for name in os.listdir(self.store_dir) if re.match(r'^SNODAS_\d{8}\.nc(\.tmp)?$', name)]
+        for name in names + ['state']:
+            path = os.path.join(self.store_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        print('Migrated %d days of SNODAS store to %s' % (store.days, store.store_dir))
+
+    def publish(self, product):
+        """Make queries of product read from days currently committed to its store."""
+        store = self.stores[product]
+        manifest = store.manifest
+        grid = SNODAS_Grid.from_transform(manifest['transform'], manifest['width'], manifest['height'])
+        generation = SNODAS_Generation(grid, store.timestamps(), manifest['ndv'], store.open_series(), store.open_days())
+
+        old = self.generations.get(product)
+        self.generations[product] = generation
+        if old is not None:
+            old.retire()
+
+    def acquire_generation(self, product):
+        while True:
+            generation = self.generations.get(product)
+            if generation is None or generation.acquire():
+                return generation
 
     @threaded
     @locked
     def get_data_test(self):
-        for i in range(100):
-            self.get_next_data()
-
-    def get_next_data(self):
-        self.make_consistent()
-        if 'max_date_1' not in self.state or self.state['max_date_1'] is None:
-            self.create_db(self.state['min_date'])
-        else:
-            self.append_db(self.state['max_date_1'] + timedelta(days=1))
-        self.save()
-
-    def create_db(self, date):
-
-        path = SNODAS_Retrieve.save_snodas(date, self.store_dir)
-        ncap_format = "ncap2 -O -s \"time=%d\" -s \"time@units=\\\"days since %s\\\"\" %s %s"
-        ncap_str = ncap_format % (0, date, path, path)
-        subprocess.call(ncap_str, shell=True)
-
-        ncecat_format = "ncecat -O --no_tmp_fl --open_ram -u time %s %s"
-        ncecat_str_1 = ncecat_format % (path, os.path.join(self.store_dir, "db_1.nc"))
-        ncecat_str_2 = ncecat_format % (path, os.path.join(self.store_dir, "db_2.nc"))
-
-        subprocess.call(ncecat_str_1, shell=True)
-        self.state['max_date_1'] = date
-        self.state['last_updated'] = self.nc_path_1
-        self.save()
-
-        self.ds_lock.acquire()
-        self.ds = xr.open_dataset(self.nc_path_1)
-        self.ds_lock.release()
-
-        subprocess.call(ncecat_str_2, shell=True)
-        self.state['max_date_2'] = date
-        self.state['last_updated'] = self.nc_path_2
-        self.save()
-
-        subprocess.call("rm %s" % path, shell=True)
-
-    def append_db(self, date):
-
-        path = SNODAS_Retrieve.save_snodas(date, self.store_dir)
-        ncap_format = "ncap2 -O -s \"time=%d\" -s \"time@units=\\\"days since %s\\\"\" %s %s"
-        ncap_str = ncap_format % ((date-self.state['min_date']).days, self.state['min_date'], path, path)
-        subprocess.call(ncap_str, shell=True)
-
-        ncecat_format = "ncecat -O --open_ram -u time %s %s"
-        ncecat_str = ncecat_format % (path, path)
-        subprocess.call(ncecat_str, shell=True)
-
-        ncrcat_format = "ncrcat --rec_apn --no_tmp_fl %s %s"
-
-        ncrcat_str_1 = ncrcat_format % (path, os.path.join(self.store_dir, "db_1.nc"))
-        ncrcat_str_2 = ncrcat_format % (path, os.path.join(self.store_dir, "db_2.nc"))
-        self.ds_lock.acquire()
-        self.ds = xr.open_dataset(self.nc_path_2)
-        self.ds_lock.release()
-        subprocess.call(ncrcat_str_1, shell=True)
-
-        self.state['max_date_1'] = date
-        self.state['last_updated'] = self.nc_path_1
-        self.save()
-
-        self.ds_lock.acquire()
-        self.ds = xr.open_dataset(self.nc_path_1)
-        self.ds_lock.release()
-        subprocess.call(ncrcat_str_2, shell=True)
-
-        self.state['max_date_2'] = date
-        self.state['last_updated'] = self.nc_path_2
-        self.save()
-
-        subprocess.call("rm %s" % path, shell=True)
-
-    @unsafe
-    def make_consistent(self):
-        # Get size of NetCDF files
-        nc_1_size = os.path.getsize(self.nc_path_1)
-        nc_2_size = os.path.getsize(self.nc_path_2)
-        # If files are of same size, set max_date to match
-        if nc_1_size == nc_2_size:
-            max_date = max(self.state['max_date_1'], self.state['max_date_2'])
-            self.state['max_date_1'] = max_date
-            self.state['max_date_2'] = max_date
-        elif 'last updated' in self.state and self.state['last_updated'] is not None:
-            not_updated = self.nc_path_1 if self.state['last_updated'] == self.nc_path_2 else self.nc_path_2
-            max_date = max(self.state['max_date_1'], self.state['max_date_2'])
-            copy2(self.state['last_updated'], not_updated)
-            self.state['max_date_1'] = max_date
-            self.state['max_date_2'] = max_date
-        # Copy smaller file to bigger file if inconsistent, set date accordingly
-        self.save()
-
-    @cache(ttl=10, max_size = 128)
-    def query(self, lat, long):
-        # Acquire lock before reading from dataset
-        self.ds_lock.acquire()
-        if self.ds is not None:
-            series = self.ds.Band1.sel(lat=lat, lon=long, method='nearest') / 10
-            timestamps = [int(x.astype('datetime64[s]').astype('int')) for x in series.coords['time'].values]
-            depths = [float(val) for val in series.values]
-            self.ds_lock.release()
-
-            res = [{'snow_depth' : depth, 'timestamp' : timestamp} for depth, timestamp in zip(depths, timestamps)]
-            return data_message(res)
+        self.backfill(100)
+
+    def next_dates(self):
+        # First day missing from store of each product, ingest resumes from here
+        return { product : store.next_date() or MIN_DATE for product, store in self.stores.items() }
+
+    def fetch(self, date, products):
+        """Get decoded grids of products for date from a single download, as
+        dictionary of product to (array, transform, ndv).
+
+        Keyword arguments:
+        date -- Date of grids
+        products -- List of product names
+        """
+        grids = SNODAS_Retrieve.snodas_grids(date, codes=[PRODUCTS[product][0] for product in products])
+        return { product : grids[PRODUCTS[product][0]] for product in products }
+
+    def backfill(self, days, workers=BACKFILL_WORKERS, in_flight=BACKFILL_IN_FLIGHT):
+        """Ingest next days of data, downloading and decoding them concurrently
+        while appending them to store one at a time in date order.
+
+        Each day is downloaded once for all products whose store is missing
+        it. Stops at the first day that fails to download. Every appended day
+        is committed to store, so calling again resumes from that day.
+
+        Keyword arguments:
+        days -- Number of days to ingest
+        workers -- Number of days downloaded at once
+        in_flight -- Maximum number of days prepared but not yet appended
+        """
+        next_dates = self.next_dates()
+        first = min(next_dates.values())
+        dates = iter([first + timedelta(days=i) for i in range(days)])
+        pending = deque()
+
+        def submit():
+            date = next(dates, None)
+            if date is not None:
+                products = [product for product, next_date in next_dates.items() if next_date <= date]
+                pending.append((date, pool.submit(self.fetch, date, products)))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for i in range(max(workers, in_flight)):
+                submit()
+            try:
+                while len(pending) > 0:
+                    date, future = pending.popleft()
+                    self.ingest(date, future.result())
+                    submit()
+            finally:
+                for date, future in pending:
+                    future.cancel()
+
+    def ingest(self, date, grids):
+        """Append decoded SNODAS grids for date to stores of their products.
+
+        Keyword arguments:
+        date -- Date of grids
+        grids -- Dictionary of product to (array, transform, ndv) as returned by fetch
+        """
+        for product, (array, transform, ndv) in grids.items():
+            store = self.stores[product]
+            store.append(date, array, transform, ndv)
+            if store.days - store.series_length >= SERIES_BLOCK_DAYS:
+                store.compact(SERIES_BAND_BYTES)
+            self.publish(product)
+
+    @cache(ttl=10, max_size = 128, normalize = query_key)
+    def query(self, lat, long, start=None, end=None, product=DEFAULT_PRODUCT):
+        if product not in PRODUCTS:
+            return error_message('Unknown product %s' % product)
+        generation = self.acquire_generation(product)
+        # Return error if dataset does not exist (no data)
+        if generation is None:
+            return error_message('No available data')
+
+        try:
+            cell = generation.grid.index(lat, long)
+            if cell is None:
+                return error_message('Location (%s, %s) is outside SNODAS grid' % (lat, long))
+            first, stop = generation.days_between(start, end)
+            timestamps = generation.timestamps[first:stop].tolist()
+            values = (generation.window([cell[0]], [cell[1]], first, stop)[0] / PRODUCTS[product][1]).tolist()
+        finally:
+            generation.release()
+
+        res = [{product : value, 'timestamp' : timestamp} for value, timestamp in zip(values, timestamps)]
+        return data_message(res)
+
+    def query_frame(self, points, start=None, end=None, product=DEFAULT_PRODUCT):
+        """Get SNODAS time series of points as dataframe with one row per point
+        and day, built straight from the stored arrays. Points outside grid
+        have no rows. Returns None if there is no data.
+
+        Keyword arguments:
+        points -- List of (lat, long) tuples
+        start -- Earliest unix timestamp (in seconds), unbounded if None
+        end -- Latest unix timestamp (in seconds), unbounded if None
+        product -- Name of product to return (default snow_depth)
+        """
+        generation = self.acquire_generation(product)
+        if generation is None:
+            return None
+
+        try:
+            lats = np.array([lat for lat, long in points], dtype='float64')
+            longs = np.array([long for lat, long in points], dtype='float64')
+            rows, cols, inside = generation.grid.indices(lats, longs)
+            first, stop = generation.days_between(start, end)
+            timestamps = generation.timestamps[first:stop]
+            # Read each cell once, however many points fall in it
+            cells, cell_of_point = np.unique(rows[inside] * generation.grid.width + cols[inside], return_inverse=True)
+            values = generation.window(cells // generation.grid.width, cells % generation.grid.width, first, stop) / PRODUCTS[product][1]
+        finally:
+            generation.release()
+
+        days = len(timestamps)
+        return pd.DataFrame({
+            'lat' : np.repeat(lats[inside], days),
+            'long' : np.repeat(longs[inside], days),
+            'timestamp' : np.tile(timestamps, int(inside.sum())),
+            product : values[cell_of_point].reshape(-1)
+        })
+
+    def gather(self, lats, longs, timestamps, product=DEFAULT_PRODUCT):
+        """Get value of product at each point on the day of its timestamp, in
+        one pass over the store. Returns None if there is no data, or array
+        with NaN for points outside grid or on days not in store.
+
+        Keyword arguments:
+        lats -- Array of latitudes
+        longs -- Array of longitudes
+        timestamps -- Array of unix timestamps (in milliseconds)
+        product -- Name of product to return (default snow_depth)
+        """
+        generation = self.acquire_generation(product)
+        if generation is None:
+            return None
+
+        try:
+            rows, cols, inside = generation.grid.indices(lats, longs)
+            # Days are stored by their midnight (UTC) timestamp
+            days = np.asarray(timestamps, dtype='int64') // 86400000 * 86400
+            indices = np.searchsorted(generation.timestamps, days)
+            found = inside & (indices < len(generation.timestamps))
+            found[found] = generation.timestamps[indices[found]] == days[found]
+            values = np.full(len(rows), np.nan)
+            values[found] = generation.gather(rows[found], cols[found], indices[found]) / PRODUCTS[product][1]
+        finally:
+            generation.release()
+        return values
+
+    def query_batch(self, points, start=None, end=None, product=DEFAULT_PRODUCT):
+        """Get SNODAS time series for many points in one read of the store.
+
+        Keyword arguments:
+        points -- List of (lat, long) tuples
+        start -- Earliest unix timestamp (in seconds), unbounded if None
+        end -- Latest unix timestamp (in seconds), unbounded if None
+        product -- Name of product to return (default snow_depth)
+        """
+        if product not in PRODUCTS:
+            return error_message('Unknown product %s' % product)
+        generation = self.acquire_generation(product)
         # Return error if dataset does not exist (no data)
-        else:
-            self.ds_lock.release()
+        if generation is None:
             return error_message('No available data')
+
+        try:
+            lats = [lat for lat, long in points]
+            longs = [long for lat, long in points]
+            rows, cols, inside = generation.grid.indices(lats, longs)
+            keys = [(product, row, col, start, end) for row, col in zip(rows.tolist(), cols.tolist())]
+            # Use cached results of cells, and gather the rest together
+            results = {}
+            missing = []
+            for key, valid in zip(keys, inside):
+                if valid and key not in results:
+                    found, val = self.cells.get(key)
+                    results[key] = val
+                    if not found:
+                        missing.append(key)
+            if len(missing) > 0:
+                first, stop = generation.days_between(start, end)
+                timestamps = generation.timestamps[first:stop].tolist()
+                values = generation.window([key[1] for key in missing], [key[2] for key in missing], first, stop) / PRODUCTS[product][1]
+                for key, series in zip(missing, values.tolist()):
+                    results[key] = [{product : value, 'timestamp' : timestamp} for value, timestamp in zip(series, timestamps)]
+                    self.cells.put(key, results[key])
+        finally:
+            generation.release()
+
+        res = []
+        for lat, long, key, valid in zip(lats, longs, keys, inside):
+            if valid:
+                res.append({ 'lat' : lat, 'long' : long, 'data' : results[key] })
+            else:
+                res.append({ 'lat' : lat, 'long' : long, 'message' : 'Location (%s, %s) is outside SNODAS grid' % (lat, long) })
+        return data_message(res)
@@ -0,0 +1,116 @@
+import numpy as np
+from threading import Lock
+
+class SNODAS_Generation():
+    """Immutable snapshot of the SNODAS store that queries read from.
+
+    Ingest publishes a new generation after each write and retires the old
+    one, which drops its memory maps once the last reader holding it
+    releases it.
+    """
+
+    def __init__(self, grid, timestamps, ndv, blocks=[], days=[]):
+        self.grid = grid
+        self.timestamps = timestamps
+        self.ndv = ndv
+        # Pixel-major blocks of series, and index of first day of each
+        self.blocks = blocks
+        self.starts = np.cumsum([0] + [block.shape[2] for block in blocks])
+        self.series_length = int(self.starts[-1])
+        self.days = days
+        self.readers = 0
+        self.retired = False
+        self.lock = Lock()
+
+    def acquire(self):
+        """Register a reader, returns False if generation has been retired."""
+        with self.lock:
+            if self.retired:
+                return False
+            self.readers += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.readers -= 1
+            if self.retired and self.readers == 0:
+                self.close()
+
+    def retire(self):
+        """Close generation once all current readers have released it."""
+        with self.lock:
+            self.retired = True
+            if self.readers == 0:
+                self.close()
+
+    def close(self):
+        # Must be called with lock held
+        self.blocks = []
+        self.days = []
+
+    def days_between(self, start=None, end=None):
+        """Get (first, stop) day indices of timestamps in [start, end].
+
+        Keyword arguments:
+        start -- Earliest unix timestamp (in seconds), unbounded if None
+        end -- Latest unix timestamp (in seconds), unbounded if None
+        """
+        first = 0 if start is None else int(np.searchsorted(self.timestamps, start, side='left'))
+        stop = len(self.timestamps) if end is None else int(np.searchsorted(self.timestamps, end, side='right'))
+        return first, max(first, stop)
+
+    def window(self, rows, cols, first, stop):
+        """Get stored values of cells for days [first, stop) as array of shape
+        (cells, days), NaN where missing.
+
+        Keyword arguments:
+        rows -- Row indices of cells
+        cols -- Column indices of cells
+        first -- Index of first day
+        stop -- Index after last day
+        """
+        rows = np.asarray(rows, dtype='int64')
+        cols = np.asarray(cols, dtype='int64')
+        parts = []
+        # Days before split are read from pixel-major series, rest from daily segments
+        split = min(max(first, self.series_length), stop)
+        # Each block overlapping window is one contiguous read per cell
+        for block, start in zip(self.blocks, self.starts):
+            lo, hi = max(first, start), min(split, start + block.shape[2])
+            if lo < hi:
+                parts.append(block[rows, cols, lo - start:hi - start])
+        if split < stop:
+            days = self.days[split - self.series_length:stop - self.series_length]
+            parts.append(np.stack([day[rows, cols] for day in days], axis=1))
+        if len(parts) == 0:
+            return np.empty((len(rows), 0))
+        values = np.concatenate(parts, axis=1).astype('float64')
+        values[values == self.ndv] = np.nan
+        return values
+
+    def gather(self, rows, cols, days):
+        """Get stored value of each (row, col, day), NaN where missing.
+
+        Keyword arguments:
+        rows -- Row indices of cells
+        cols -- Column indices of cells
+        days -- Day indices, one per cell
+        """
+        rows = np.asarray(rows, dtype='int64')
+        cols = np.asarray(cols, dtype='int64')
+        days = np.asarray(days, dtype='int64')
+        values = np.full(len(rows), np.nan)
+        # Days in series are read in one fancy index per block
+        blocks = np.searchsorted(self.starts, days, side='right') - 1
+        for index in np.unique(blocks[days < self.series_length]):
+            group = np.flatnonzero(blocks == index)
+            values[group] = self.blocks[index][rows[group], cols[group], days[group] - self.starts[index]]
+        # Other days are read once each from their segment
+        rest = np.flatnonzero(days >= self.series_length)
+        rest = rest[np.argsort(days[rest], kind='mergesort')]
+        bounds = np.flatnonzero(np.diff(days[rest])) + 1
+        for group in np.split(rest, bounds) if len(rest) > 0 else []:
+            day = self.days[days[group[0]] - self.series_length]
+            values[group] = day[rows[group], cols[group]]
+        values[values == self.ndv] = np.nan
+        return values
@@ -0,0 +1,59 @@
+import numpy as np
+
+# Geotransform, width and height of unmasked SNODAS products, as in their headers
+UNMASKED_TRANSFORM = (-130.516666666661, 68.2666666666635 / 8192, 0.0, 58.2333333333310, 0.0, -34.133333333332 / 4096)
+UNMASKED_WIDTH = 8192
+UNMASKED_HEIGHT = 4096
+
+class SNODAS_Grid():
+    """Regular lat/long grid of SNODAS cells, mapping coordinates to indices."""
+
+    def __init__(self, lat_0, lat_step, height, long_0, long_step, width):
+        self.lat_0 = lat_0
+        self.lat_step = lat_step
+        self.height = height
+        self.long_0 = long_0
+        self.long_step = long_step
+        self.width = width
+
+    @classmethod
+    def from_transform(cls, transform, width, height):
+        """Get grid from GDAL geotransform of north-up raster.
+
+        Keyword arguments:
+        transform -- GDAL geotransform
+        width -- Number of columns
+        height -- Number of rows
+        """
+        return cls(transform[3] + transform[5] / 2, transform[5], height, transform[0] + transform[1] / 2, transform[1], width)
+
+    @classmethod
+    def unmasked(cls):
+        """Get grid of unmasked SNODAS products, used since 2010."""
+        return cls.from_transform(UNMASKED_TRANSFORM, UNMASKED_WIDTH, UNMASKED_HEIGHT)
+
+    def indices(self, lat, long):
+        """Get (row, col, inside) arrays for cells nearest to points, where
+        inside is False for points outside the grid.
+
+        Keyword arguments:
+        lat -- Array of latitudes
+        long -- Array of longitudes
+        """
+        rows = np.rint((np.asarray(lat, dtype='float64') - self.lat_0) / self.lat_step)
+        cols = np.rint((np.asarray(long, dtype='float64') - self.long_0) / self.long_step)
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        rows = np.where(inside, rows, 0).astype('int64')
+        cols = np.where(inside, cols, 0).astype('int64')
+        return rows, cols, inside
+
+    def index(self, lat, long):
+        """Get (row, col) index of cell containing point, or None if outside grid."""
+        rows, cols, inside = self.indices([lat], [long])
+        if not inside[0]:
+            return None
+        return int(rows[0]), int(cols[0])
+
+    def center(self, row, col):
+        """Get (lat, long) of center of cell."""
+        return self.lat_0 + row * self.lat_step, self.long_0 + col * self.long_step
@@ -1,13 +1,30 @@
 import re
 import os
+import shutil
 import tarfile
 import gzip
 from datetime import datetime, timedelta
+from threading import Lock
 from io import BytesIO
-from osgeo import gdal, gdal_array, osr
 
 import numpy as np
 import common.utils as ut
+from resources.snodas.SNODAS_Cache import SNODAS_Cache
+
+# Root of SNODAS archive, SNODAS_BASE_URL can point at a local mirror (e.g. file:///data/G02158)
+BASE_URL = 'ftp://sidads.colorado.edu/DATASETS/NOAA/G02158'
+# Local cache of downloaded archives and decoded grids (compressed), built by snodas_cache
+CACHE = None
+CACHE_LOCK = Lock()
+
+def snodas_cache():
+    """Get cache of archives and grids, built on first use so SNODAS_CACHE_DIR
+    and SNODAS_CACHE_BYTES (disabled if 0) can be set in .env."""
+    global CACHE
+    with CACHE_LOCK:
+        if CACHE is None:
+            CACHE = SNODAS_Cache(os.getenv('SNODAS_CACHE_DIR', '.store/snodas_cache'), int(os.getenv('SNODAS_CACHE_BYTES', 20 * 1024 ** 3)))
+        return CACHE
 
 def snodas_url(date):
     """Get url of SNODAS data for given date.
@@ -15,10 +32,12 @@ def snodas_url(date):
     Keyword arguments:
     date -- Date to fetch SNODAS data for
     """
+    # Read when used, so it can be set in .env
+    base_url = os.getenv('SNODAS_BASE_URL', BASE_URL)
     if date >= datetime(2003,9,30) and date < datetime(2010,1,1):
-        return date.strftime('ftp://sidads.colorado.edu/DATASETS/NOAA/G02158/masked/%Y/%m_%b/SNODAS_%Y%m%d.tar')
+        return base_url + date.strftime('/masked/%Y/%m_%b/SNODAS_%Y%m%d.tar')
     elif date >= datetime(2010,1,1):
-        return date.strftime('ftp://sidads.colorado.edu/DATASETS/NOAA/G02158/unmasked/%Y/%m_%b/SNODAS_unmasked_%Y%m%d.tar')
+        return base_url + date.strftime('/unmasked/%Y/%m_%b/SNODAS_unmasked_%Y%m%d.tar')
 
 
 def snodas_file_format(date):
@@ -32,90 +51,156 @@ def snodas_file_format(date):
     elif date >= datetime(2010,1,1):
         return date.strftime('zz_ssmv1%%itS__T0001TTNATS%Y%m%d05HP001.%%s.gz')
 
+def cached_archive(date):
+    """Get open file of SNODAS archive for date from cache, downloading it
+    into cache first if needed. Returns None if cache is disabled.
 
-
-# Remove lines longer than 256 characters from header (GDAL requirement)
-def clean_header(hdr):
-    """Remove lines longer than 256 characters from header (GDAL requirement)."""
-    new_hdr = BytesIO()
-    for line in hdr:
-        if len(line) <= 256:
-            new_hdr.write(line)
-
-    # Cleanup
-    new_hdr.write(b'')
-    new_hdr.seek(0)
-    hdr.close()
-
-    return new_hdr
-
-def clean_paths(paths, tar):
-    """Corrects paths of files in tar."""
-    new_paths = []
-    for path in paths:
+    Keyword arguments:
+    date -- datetime object
+    """
+    cache = snodas_cache()
+    if not cache.enabled:
+        return None
+    name = cache.archive_name(date)
+    archive = cache.open(name)
+    if archive is None:
+        stream = ut.url_to_stream(snodas_url(date))
         try:
-            info = tar.getmember(path)
-        except:
-            path = './' + path
-        new_paths.append(path)
-    return new_paths
-
-def tar_to_snodas(tar, gz_format, code=1036):
-    """Converts tar archive to GDAL dataset.
+            cache.put(name, lambda file: shutil.copyfileobj(stream, file))
+        finally:
+            stream.close()
+        archive = cache.open(name)
+    return archive
+
+def parse_header(hdr):
+    """Parse SNODAS header into dictionary of its 'key: value' lines."""
+    header = {}
+    for line in hdr.decode('ascii', 'replace').splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            header[key.strip()] = value.strip()
+    return header
+
+def header_grid(header):
+    """Get (width, height, transform, ndv, dtype) of grid described by header.
 
     Keyword arguments:
-    tar -- tar object
-    gz_format -- format for gzipped files in archive
-    code -- SNODAS product code (default 1036 [Snow Depth])
+    header -- Dictionary returned by parse_header
     """
+    width = int(header['Number of columns'])
+    height = int(header['Number of rows'])
+    min_x, max_x = float(header['Minimum x-axis coordinate']), float(header['Maximum x-axis coordinate'])
+    min_y, max_y = float(header['Minimum y-axis coordinate']), float(header['Maximum y-axis coordinate'])
+    # Same geotransform the GDAL SNODAS driver derives from header
+    transform = (min_x, (max_x - min_x) / width, 0.0, max_y, 0.0, -(max_y - min_y) / height)
+    ndv = float(header['No data value'])
+    dtype = np.dtype('>i2' if header.get('Byte order', '1') == '1' else '<i2')
+    if int(header['Data bytes per pixel']) != dtype.itemsize:
+        raise ValueError('Unsupported SNODAS pixel size %s' % header['Data bytes per pixel'])
+    return width, height, transform, ndv, dtype
+
+def read_into(file, buffer):
+    """Fill buffer from file, raising if file ends first."""
+    view = memoryview(buffer).cast('B')
+    offset = 0
+    while offset < len(view):
+        count = file.readinto(view[offset:])
+        if not count:
+            raise ValueError('SNODAS data ended after %d of %d bytes' % (offset, len(view)))
+        offset += count
+
+def decode_dat(dat_gz, header):
+    """Decompress gzipped SNODAS data described by header into a new array.
+    Returns (array, transform, ndv) with array north-up.
 
-    extensions = ['dat', 'Hdr']
-    # Untar and extract files
-    gz_paths = [gz_format % (code, extension) for extension in extensions]
-    vsi_paths = ['/vsimem/' + path[:-3] for path in gz_paths]
-
-    # Some paths in tar file have ./ preceeding, some do not
-    # Use clean_tar_paths to find and use correct paths
-    gz_paths = clean_paths(gz_paths, tar)
-
-    gz_files = [tar.extractfile(path) for path in gz_paths]
-    dat_file, hdr_file = [gzip.GzipFile(fileobj=file, mode='r') for file in gz_files]
-
-    # Read data into buffers
-    hdr_file = clean_header(hdr_file)
-    dat = dat_file.read()
-    hdr = hdr_file.read()
-
-    # Convert to GDAL Dataset
-    gdal.FileFromMemBuffer(vsi_paths[0], dat)
-    gdal.FileFromMemBuffer(vsi_paths[1], hdr)
-    ds = gdal.Open(vsi_paths[1])
+    Keyword arguments:
+    dat_gz -- File object of gzipped .dat file
+    header -- Dictionary returned by parse_header
+    """
+    width, height, transform, ndv, dtype = header_grid(header)
+    array = np.empty((height, width), dtype=dtype)
+    with gzip.GzipFile(fileobj=dat_gz, mode='r') as dat_file:
+        read_into(dat_file, array)
+    # Convert to native byte order in place
+    if not dtype.isnative:
+        array = array.byteswap(inplace=True).view(dtype.newbyteorder('='))
+    return array, transform, ndv
+
+def stream_snodas(stream, gz_format, codes=[1036]):
+    """Decode SNODAS grids of several products from tar archive stream in a
+    single forward pass.
+
+    Only the headers and data of the products are decompressed, reading
+    stops once all are found, and data is decompressed directly into the
+    returned arrays. Returns dictionary of product code to
+    (array, transform, ndv) with arrays north-up.
 
-    # Close / Unlink Virtual Files
+    Keyword arguments:
+    stream -- File object of tar archive, read sequentially
+    gz_format -- format for gzipped files in archive
+    codes -- List of SNODAS product codes (default [1036] [Snow Depth])
+    """
+    paths = {}
+    for code in codes:
+        for extension in ['dat', 'Hdr']:
+            paths[gz_format % (code, extension)] = (code, extension)
+    headers = {}
+    grids = {}
+    # Data stays compressed in memory if it comes before its header in archive
+    pending = {}
+    tar = tarfile.open(fileobj=stream, mode='r|')
+    for member in tar:
+        # Some paths in tar file have ./ preceeding, some do not
+        name = member.name[2:] if member.name.startswith('./') else member.name
+        if name not in paths:
+            continue
+        code, extension = paths[name]
+        file = tar.extractfile(member)
+        if extension == 'Hdr':
+            with gzip.GzipFile(fileobj=file, mode='r') as hdr_file:
+                headers[code] = parse_header(hdr_file.read())
+            if code in pending:
+                grids[code] = decode_dat(pending.pop(code), headers[code])
+        elif code in headers:
+            grids[code] = decode_dat(file, headers[code])
+        else:
+            pending[code] = BytesIO(file.read())
+        if len(grids) == len(codes):
+            break
     tar.close()
-    dat_file.close()
-    hdr_file.close()
-    gdal.Unlink(vsi_paths[0])
-    gdal.Unlink(vsi_paths[1])
 
-    return ds
+    missing = [code for code in codes if code not in grids]
+    if len(missing) > 0:
+        raise ValueError('SNODAS products %s not found in archive' % missing)
+    return grids
 
-def snodas_ds(date, code=1036):
-    """Get SNODAS data as GDAL dataset for specific date.
+def snodas_grids(date, codes=[1036]):
+    """Get SNODAS data of several products for specific date from one
+    download, as dictionary of product code to (array, transform, ndv), where
+    arrays are north-up and transform is the GDAL geotransform of the grid.
 
     Keyword arguments:
     date -- datetime object
-    code -- integer specifying SNODAS product (default 1036 [Snow Depth])
+    codes -- List of SNODAS product codes (default [1036] [Snow Depth])
     """
-    url = snodas_url(date)
-    gz_format = snodas_file_format(date)
-    tar = ut.url_to_tar(url)
-    return tar_to_snodas(tar, gz_format, code=code)
-
-def save_snodas(date, path):
-    path = os.path.join(path, date.strftime('SNODAS_%Y%m%d.nc'))
-    if not os.path.exists(path):
-        ds = snodas_ds(date)
-        ut.save_netcdf(ds, path)
-
-    return path
+    cache = snodas_cache()
+    grids = {}
+    for code in codes:
+        file = cache.open(cache.grid_name(date, code))
+        if file is not None:
+            with file, np.load(file) as npz:
+                grids[code] = npz['array'], tuple(npz['transform'].tolist()), float(npz['ndv'])
+    missing = [code for code in codes if code not in grids]
+    if len(missing) == 0:
+        return grids
+
+    # Archive is only streamed straight from server when cache is disabled
+    stream = cached_archive(date) or ut.url_to_stream(snodas_url(date))
+    try:
+        decoded = stream_snodas(stream, snodas_file_format(date), codes=missing)
+    finally:
+        stream.close()
+    for code, (array, transform, ndv) in decoded.items():
+        cache.put(cache.grid_name(date, code), lambda file: np.savez_compressed(file, array=array, transform=transform, ndv=ndv))
+    grids.update(decoded)
+    return grids
@@ -0,0 +1,156 @@
+import os
+import re
+import calendar
+from datetime import datetime, timedelta
+
+import numpy as np
+from common.utils import save_json, load_json
+
+DATE_FORMAT = '%Y-%m-%d'
+
+class SNODAS_Store():
+    """Journaled store of daily SNODAS grids.
+
+    Each day is written to its own .npy segment, fsynced, and only then
+    committed by atomically replacing the manifest. Segments the manifest
+    does not cover are left over from an interrupted append and are
+    discarded on load. Committed days are periodically compacted into a
+    pixel-major block of the series, after which their segments are removed.
+    Blocks are only ever added, each holding the days compacted at once.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.days_dir = os.path.join(store_dir, 'days')
+        self.manifest_path = os.path.join(store_dir, 'manifest')
+        if not os.path.exists(self.days_dir):
+            os.makedirs(self.days_dir)
+        self.manifest = load_json(self.manifest_path)
+        self.recover()
+
+    def recover(self):
+        # Discard temporary files, segments of days never committed and
+        # segments already compacted into series
+        for name in os.listdir(self.days_dir):
+            match = re.match(r'^(\d+)\.npy$', name)
+            if match is None or not self.series_length <= int(match.group(1)) < self.days:
+                os.remove(os.path.join(self.days_dir, name))
+        # Discard blocks written but never committed
+        for name in os.listdir(self.store_dir):
+            match = re.match(r'^series_(\d+)\.npy', name)
+            if match is not None and (int(match.group(1)) not in self.blocks or name.endswith('.tmp')):
+                os.remove(os.path.join(self.store_dir, name))
+
+    @property
+    def days(self):
+        return self.manifest['days'] if self.manifest is not None else 0
+
+    @property
+    def series_length(self):
+        return self.manifest['series_length'] if self.manifest is not None else 0
+
+    @property
+    def blocks(self):
+        """Index of first day of each block of series."""
+        return self.manifest['blocks'] if self.manifest is not None else []
+
+    @property
+    def min_date(self):
+        return datetime.strptime(self.manifest['min_date'], DATE_FORMAT)
+
+    def next_date(self):
+        """Get date of next day to append, or None if store was never created."""
+        if self.manifest is None:
+            return None
+        return self.min_date + timedelta(days=self.days)
+
+    def timestamps(self):
+        """Get unix timestamps (in seconds) of committed days."""
+        start = calendar.timegm(self.min_date.timetuple())
+        return start + 86400 * np.arange(self.days, dtype='int64')
+
+    def day_path(self, index):
+        return os.path.join(self.days_dir, '%06d.npy' % index)
+
+    def block_path(self, first):
+        return os.path.join(self.store_dir, 'series_%06d.npy' % first)
+
+    def commit(self, **changes):
+        # Replacing manifest is the only step that makes changes visible
+        manifest = { **self.manifest, **changes }
+        save_json(manifest, self.manifest_path)
+        self.manifest = manifest
+
+    def append(self, date, array, transform, ndv):
+        """Write and commit grid of next day.
+
+        Keyword arguments:
+        date -- Date of grid, must be the day after the last committed day
+        array -- Grid of day, north-up as read by GDAL
+        transform -- GDAL geotransform of grid
+        ndv -- No data value of grid
+        """
+        if self.manifest is None:
+            self.manifest = {
+                'min_date' : date.strftime(DATE_FORMAT),
+                'days' : 0,
+                'series_length' : 0,
+                'blocks' : [],
+                'transform' : [float(x) for x in transform],
+                'width' : array.shape[1],
+                'height' : array.shape[0],
+                'ndv' : float(ndv)
+            }
+        if date != self.next_date():
+            raise ValueError('Expected %s, got %s' % (self.next_date(), date))
+        if list(array.shape) != [self.manifest['height'], self.manifest['width']]:
+            raise ValueError('Grid shape %s does not match store' % (array.shape,))
+
+        path = self.day_path(self.days)
+        with open(path + '.tmp', 'wb') as file:
+            np.save(file, array.astype('int16'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+        self.commit(days=self.days + 1)
+
+    def open_series(self):
+        """Get memory-mapped pixel-major blocks of series, in order of days."""
+        return [np.load(self.block_path(first), mmap_mode='r') for first in self.blocks]
+
+    def open_days(self):
+        """Get memory-mapped grids of committed days not yet in series."""
+        return [np.load(self.day_path(index), mmap_mode='r') for index in range(self.series_length, self.days)]
+
+    def compact(self, band_bytes):
+        """Write committed days not yet in series as a new pixel-major block,
+        so the history of a cell is one contiguous read per block. Days
+        already in series are not copied again.
+
+        Keyword arguments:
+        band_bytes -- Approximate bytes of block copied at a time
+        """
+        height, width = self.manifest['height'], self.manifest['width']
+        first, length = self.series_length, self.days - self.series_length
+        if length == 0:
+            return
+        days = self.open_days()
+
+        path = self.block_path(first)
+        tmp_path = path + '.tmp'
+        block = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='int16', shape=(height, width, length))
+        # Copy in bands of rows to bound memory use
+        rows = max(1, band_bytes // (width * length * 2))
+        for row in range(0, height, rows):
+            for index, day in enumerate(days):
+                block[row:row + rows, :, index] = day[row:row + rows]
+        block.flush()
+        del block
+        with open(tmp_path, 'rb') as file:
+            os.fsync(file.fileno())
+
+        # Block is only read once commit lists it, until then its days are read from segments
+        os.replace(tmp_path, path)
+        self.commit(series_length=self.days, blocks=self.blocks + [first])
+        for index in range(first, first + length):
+            os.remove(self.day_path(index))